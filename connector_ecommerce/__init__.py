@@ -24,6 +24,7 @@ from . import account
 from . import product
 from . import invoice
 from . import payment_method
+from . import partner
 from . import event
 from . import unit
 from . import sale
@@ -19,36 +19,122 @@
 #
 ##############################################################################
 
+from bisect import bisect_left, bisect_right
+
+from openerp import SUPERUSER_ID
 from openerp.osv import orm, fields
+from openerp.tools import ormcache
 
 
 class account_tax_code(orm.Model):
     _inherit = 'account.tax'
 
-    def get_tax_from_rate(self, cr, uid, rate, is_tax_included=False,
-                          context=None):
+    @ormcache(skiparg=3)
+    def _tax_rate_index(self, cr, uid, company_id):
+        """ Return the active sale taxes of a company indexed by rate
+
+        The index is a dict with ``(price_include, type_tax_use)`` as
+        keys. The values are tuples ``(rates, taxes)`` where ``rates``
+        is the sorted list of the rates and ``taxes`` the list of
+        ``(sequence, id)`` of the taxes, in the same order.
+
+        It is cached until a tax is created, modified or deleted, or
+        until a transaction which modified a tax is rolled back.
+        """
+        tax_ids = self.search(cr, SUPERUSER_ID,
+                              [('company_id', '=', company_id),
+                               ('type_tax_use', 'in', ['sale', 'all'])])
+        taxes = self.read(cr, SUPERUSER_ID, tax_ids,
+                          ['amount', 'price_include', 'type_tax_use',
+                           'sequence'])
+        taxes_by_key = {}
+        for tax in taxes:
+            key = (tax['price_include'], tax['type_tax_use'])
+            taxes_by_key.setdefault(key, []).append(
+                (tax['amount'], tax['sequence'], tax['id'])
+            )
+        index = {}
+        for key, values in taxes_by_key.iteritems():
+            values.sort()
+            index[key] = (tuple(amount for amount, __, __ in values),
+                          tuple((sequence, tax_id)
+                                for __, sequence, tax_id in values))
+        return index
+
+    def _tax_from_index(self, index, rate, is_tax_included, precision):
+        """ Search a tax in the index with a rate between
+        ``rate - precision`` and ``rate + precision``.
+
+        Return the tax with the lowest sequence or False.
+        """
+        candidates = []
+        for type_tax_use in ('sale', 'all'):
+            rates, taxes = index.get((is_tax_included, type_tax_use),
+                                     ((), ()))
+            start = bisect_left(rates, rate - precision)
+            stop = bisect_right(rates, rate + precision)
+            candidates += taxes[start:stop]
+        if candidates:
+            __, tax_id = min(candidates)
+            return tax_id
+        return False
+
+    def get_taxes_from_rates(self, cr, uid, rates, is_tax_included=False,
+                             context=None):
+        """ Return the sale taxes of the company of the user matching
+        the rates
+
+        :param rates: list of rates
+        :param is_tax_included: search taxes with a price included
+        :return: dict with the rates as keys and the ids of the taxes
+                 (or False when no tax matches) as values
+        """
         # TODO improve, if tax are not correctly mapped the order should
         # be in exception (integration with sale_execption)
-        account_tax_obj = self.pool['account.tax']
-        tax_ids = account_tax_obj.search(
-            cr, uid,
-            [('price_include', '=', is_tax_included),
-             ('type_tax_use', 'in', ['sale', 'all']),
-             ('amount', '>=', rate - 0.001),
-             ('amount', '<=', rate + 0.001)])
-        if tax_ids:
-            return tax_ids[0]
-        else:
-            # try to find a tax with less precision
-            tax_ids = account_tax_obj.search(
-                cr, uid,
-                [('price_include', '=', is_tax_included),
-                 ('type_tax_use', 'in', ['sale', 'all']),
-                 ('amount', '>=', rate - 0.01),
-                 ('amount', '<=', rate + 0.01)])
-            if tax_ids:
-                return tax_ids[0]
-        return False
+        user_obj = self.pool['res.users']
+        company_id = user_obj._get_company(cr, uid, context=context)
+        index = self._tax_rate_index(cr, uid, company_id)
+        result = {}
+        for rate in rates:
+            if rate in result:
+                continue
+            tax_id = self._tax_from_index(index, rate, is_tax_included,
+                                          0.001)
+            if not tax_id:
+                # try to find a tax with less precision
+                tax_id = self._tax_from_index(index, rate, is_tax_included,
+                                              0.01)
+            result[rate] = tax_id
+        return result
+
+    def get_tax_from_rate(self, cr, uid, rate, is_tax_included=False,
+                          context=None):
+        taxes = self.get_taxes_from_rates(cr, uid, [rate],
+                                          is_tax_included=is_tax_included,
+                                          context=context)
+        return taxes[rate]
+
+    def _clear_tax_rate_index(self, cr):
+        """ Clear the index of the taxes, again if the transaction is
+        rolled back, so the index does not keep the taxes of a
+        rolled back transaction """
+        self.clear_caches()
+        cr.after('rollback', self.clear_caches)
+
+    def create(self, cr, uid, vals, context=None):
+        self._clear_tax_rate_index(cr)
+        return super(account_tax_code, self).create(cr, uid, vals,
+                                                    context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        self._clear_tax_rate_index(cr)
+        return super(account_tax_code, self).write(cr, uid, ids, vals,
+                                                   context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        self._clear_tax_rate_index(cr)
+        return super(account_tax_code, self).unlink(cr, uid, ids,
+                                                    context=context)
 
 
 class account_tax_group(orm.Model):
@@ -85,3 +85,102 @@ because it depends on the pricelists.
  * record_id: id of the record
 
 """
+
+
+# Batch variants of the events above. They carry a list of ids instead
+# of a single id, so the listeners can create one job or do one call
+# to the backend for a chunk of records. The ``_batch`` events are
+# forwarded to their single record counterpart by the consumers below,
+# so existing listeners are still called once per record.
+
+on_picking_out_done_batch = Event()
+"""
+``on_picking_out_done_batch`` is fired when outgoing pickings have been
+marked as done. It is fired once for the 'partial' pickings and once for
+the 'complete' pickings.
+
+Listeners should take the following arguments:
+
+ * session: `connector.session.ConnectorSession` object
+ * model_name: name of the model
+ * record_ids: list of ids of the records
+ * type: 'partial' or 'complete' depending on the picking done
+"""
+
+
+on_tracking_number_added_batch = Event()
+"""
+``on_tracking_number_added_batch`` is fired when pickings have been
+marked as done and a tracking number has been added to them (write).
+
+Listeners should take the following arguments:
+
+ * session: `connector.session.ConnectorSession` object
+ * model_name: name of the model
+ * record_ids: list of ids of the records
+"""
+
+
+on_invoice_paid_batch = Event()
+"""
+``on_invoice_paid_batch`` is fired when invoices have been paid.
+
+Listeners should take the following arguments:
+
+ * session: `connector.session.ConnectorSession` object
+ * model_name: name of the model
+ * record_ids: list of ids of the records
+"""
+
+on_invoice_validated_batch = Event()
+"""
+``on_invoice_validated_batch`` is fired when invoices have been
+validated.
+
+Listeners should take the following arguments:
+
+ * session: `connector.session.ConnectorSession` object
+ * model_name: name of the model
+ * record_ids: list of ids of the records
+"""
+
+on_product_price_changed_batch = Event()
+"""
+``on_product_price_changed_batch`` is fired when the price of products
+is changed. See ``on_product_price_changed``.
+
+ * session: `connector.session.ConnectorSession` object
+ * model_name: name of the model
+ * record_ids: list of ids of the records
+
+"""
+
+
+@on_picking_out_done_batch()
+def picking_out_done_batch(session, model_name, record_ids, picking_type):
+    for record_id in record_ids:
+        on_picking_out_done.fire(session, model_name, record_id, picking_type)
+
+
+@on_tracking_number_added_batch()
+def tracking_number_added_batch(session, model_name, record_ids):
+    for record_id in record_ids:
+        on_tracking_number_added.fire(session, model_name, record_id)
+
+
+@on_invoice_paid_batch()
+def invoice_paid_batch(session, model_name, record_ids):
+    for record_id in record_ids:
+        on_invoice_paid.fire(session, model_name, record_id)
+
+
+@on_invoice_validated_batch()
+def invoice_validated_batch(session, model_name, record_ids):
+    for record_id in record_ids:
+        on_invoice_validated.fire(session, model_name, record_id)
+
+
+@on_product_price_changed_batch()
+def product_price_changed_batch(session, model_name, record_ids):
+    for record_id in record_ids:
+        on_product_price_changed.fire(session, model_name, record_id)
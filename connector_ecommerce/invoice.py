@@ -21,7 +21,7 @@
 
 from openerp.osv import fields, orm
 from openerp.addons.connector.session import ConnectorSession
-from .event import on_invoice_paid, on_invoice_validated
+from .event import on_invoice_paid_batch, on_invoice_validated_batch
 
 
 class account_invoice(orm.Model):
@@ -42,14 +42,12 @@ class account_invoice(orm.Model):
         res = super(account_invoice, self).confirm_paid(
             cr, uid, ids, context=context)
         session = ConnectorSession(cr, uid, context=context)
-        for record_id in ids:
-            on_invoice_paid.fire(session, self._name, record_id)
+        on_invoice_paid_batch.fire(session, self._name, ids)
         return res
 
     def invoice_validate(self, cr, uid, ids, context=None):
         res = super(account_invoice, self).invoice_validate(
             cr, uid, ids, context=context)
         session = ConnectorSession(cr, uid, context=context)
-        for record_id in ids:
-            on_invoice_validated.fire(session, self._name, record_id)
+        on_invoice_validated_batch.fire(session, self._name, ids)
         return res
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+
+from openerp.osv import orm
+from .unit.sale_order_onchange import (has_onchange_caches,
+                                       invalidate_onchange_caches)
+
+
+class res_partner(orm.Model):
+    _inherit = 'res.partner'
+
+    def _invalidate_onchange_caches(self, cr, ids):
+        """ Drop the results of the partner onchanges cached for all
+        the partners of the trees of the partners: the onchange of a
+        contact reads the addresses among the contacts of its commercial
+        partner and the commercial fields of its parents """
+        partner_ids = set(ids)
+        parent_ids = ids
+        while parent_ids:
+            cr.execute("SELECT parent_id FROM res_partner "
+                       "WHERE id IN %s AND parent_id IS NOT NULL",
+                       (tuple(parent_ids),))
+            parent_ids = [parent_id for parent_id, in cr.fetchall()
+                          if parent_id not in partner_ids]
+            partner_ids.update(parent_ids)
+        # all the partners found are in the trees of the roots reached,
+        # so their descendants are the whole trees
+        child_ids = list(partner_ids)
+        while child_ids:
+            cr.execute("SELECT id FROM res_partner WHERE parent_id IN %s",
+                       (tuple(child_ids),))
+            child_ids = [child_id for child_id, in cr.fetchall()
+                         if child_id not in partner_ids]
+            partner_ids.update(child_ids)
+        invalidate_onchange_caches('partner_id', list(partner_ids))
+
+    def create(self, cr, uid, vals, context=None):
+        partner_id = super(res_partner, self).create(cr, uid, vals,
+                                                     context=context)
+        if has_onchange_caches():
+            self._invalidate_onchange_caches(cr, [partner_id])
+        return partner_id
+
+    def write(self, cr, uid, ids, vals, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if has_onchange_caches():
+            # the previous parents
+            self._invalidate_onchange_caches(cr, ids)
+        result = super(res_partner, self).write(cr, uid, ids, vals,
+                                                context=context)
+        if has_onchange_caches() and 'parent_id' in vals:
+            # the new parents
+            self._invalidate_onchange_caches(cr, ids)
+        return result
+
+    def unlink(self, cr, uid, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if has_onchange_caches():
+            self._invalidate_onchange_caches(cr, ids)
+        return super(res_partner, self).unlink(cr, uid, ids,
+                                               context=context)
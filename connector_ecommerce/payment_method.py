@@ -19,7 +19,19 @@
 #
 ##############################################################################
 
+import logging
+
+import psycopg2
+from psycopg2 import errorcodes
+
 from openerp.osv import orm, fields
+from openerp.tools import ormcache, ustr
+from openerp.tools.translate import _
+from openerp.addons.connector.exception import RetryableJobError
+from .unit.sale_order_onchange import (has_onchange_caches,
+                                       invalidate_onchange_caches)
+
+_logger = logging.getLogger(__name__)
 
 
 class payment_method(orm.Model):
@@ -52,6 +64,82 @@ class payment_method(orm.Model):
         'days_before_cancel': 30,
     }
 
+    def init(self, cr):
+        """ Create a unique index on the lowercase name of the payment
+        methods, so concurrent imports can't create duplicates """
+        index_name = 'payment_method_lower_name_company_uniq'
+        cr.execute("SELECT indexname FROM pg_indexes WHERE indexname = %s",
+                   (index_name,))
+        if cr.fetchone():
+            return
+        cr.execute("SELECT lower(name) FROM payment_method "
+                   "GROUP BY lower(name), company_id HAVING count(*) > 1")
+        duplicates = [row[0] for row in cr.fetchall()]
+        if duplicates:
+            _logger.warning('The unique index %s on the payment methods '
+                            'cannot be created because of duplicate '
+                            'names: %s', index_name, ', '.join(duplicates))
+            return
+        cr.execute("CREATE UNIQUE INDEX %s ON payment_method "
+                   "(lower(name), COALESCE(company_id, 0))" % index_name)
+
+    @ormcache()
+    def _payment_method_ids_by_name(self, cr, uid):
+        """ Return a dict with the lowercase names of the payment methods
+        as keys and their ids as values """
+        method_ids = self.search(cr, uid, [])
+        methods = self.read(cr, uid, method_ids, ['name'])
+        result = {}
+        for method in methods:
+            result.setdefault(method['name'].lower(), method['id'])
+        return result
+
+    def _create_payment_method(self, cr, uid, payment_method,
+                               context=None):
+        """ Create a payment method
+
+        When another transaction creates the same payment method at
+        the same time, the unique index raises an error and the import
+        job is retried.
+        """
+        try:
+            with cr.savepoint():
+                method_id = self.create(cr, uid, {'name': payment_method},
+                                        context=context)
+        except psycopg2.IntegrityError as err:
+            if err.pgcode != errorcodes.UNIQUE_VIOLATION:
+                raise
+            raise RetryableJobError(
+                _('The payment method %s is being created by another '
+                  'transaction.') % payment_method)
+        # do not keep the id in the cache if the transaction is
+        # rolled back
+        cr.after('rollback', self.clear_caches)
+        return method_id
+
+    def get_or_create_payment_methods(self, cr, uid, payment_methods,
+                                      context=None):
+        """
+        try to get ids of 'payment_methods' or create the missing ones
+        :param list payment_methods: names of payment methods
+        :rtype: dict
+        :return: ids of the payment methods, with names as keys
+        """
+        method_ids = self._payment_method_ids_by_name(cr, uid).copy()
+        result = {}
+        for payment_method in payment_methods:
+            if payment_method in result:
+                continue
+            key = ustr(payment_method).lower()
+            method_id = method_ids.get(key)
+            if method_id is None:
+                method_id = self._create_payment_method(cr, uid,
+                                                        payment_method,
+                                                        context=context)
+                method_ids[key] = method_id
+            result[payment_method] = method_id
+        return result
+
     def get_or_create_payment_method(self, cr, uid, payment_method,
                                      context=None):
         """
@@ -60,13 +148,29 @@ class payment_method(orm.Model):
         :rtype: int
         :return: id of required payment method
         """
-        pay_method_obj = self.pool.get('payment.method')
-        domain = [('name', '=ilike', payment_method)]
-        method_ids = pay_method_obj.search(cr, uid, domain, context=context)
-        if method_ids:
-            method_id = method_ids[0]
-        else:
-            method_id = pay_method_obj.create(cr, uid,
-                                              {'name': payment_method},
-                                              context=context)
-        return method_id
+        method_ids = self.get_or_create_payment_methods(
+            cr, uid, [payment_method], context=context)
+        return method_ids[payment_method]
+
+    def create(self, cr, uid, vals, context=None):
+        self.clear_caches()
+        return super(payment_method, self).create(cr, uid, vals,
+                                                  context=context)
+
+    def _invalidate_onchange_caches(self, ids):
+        if has_onchange_caches():
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            invalidate_onchange_caches('payment_method_id', ids)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        self.clear_caches()
+        self._invalidate_onchange_caches(ids)
+        return super(payment_method, self).write(cr, uid, ids, vals,
+                                                 context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        self.clear_caches()
+        self._invalidate_onchange_caches(ids)
+        return super(payment_method, self).unlink(cr, uid, ids,
+                                                  context=context)
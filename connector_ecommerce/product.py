@@ -19,9 +19,45 @@
 #
 ##############################################################################
 
+import logging
+import weakref
+from functools import partial
+
+from openerp import SUPERUSER_ID
 from openerp.osv import orm, fields
+from openerp.tools import ormcache
+from openerp.tools.translate import _
+from openerp.addons.connector.queue.job import job
 from openerp.addons.connector.session import ConnectorSession
-from .event import on_product_price_changed
+from .event import on_product_price_changed_batch
+
+_logger = logging.getLogger(__name__)
+
+# above this number of variants, the price changed events of the
+# variants of a template are fired in a job
+VARIANTS_DEFER_THRESHOLD = 1000
+# number of variants per ``on_product_price_changed_batch`` in the job
+VARIANTS_CHUNK_SIZE = 500
+
+# fields of the products cached by
+# ``product_product.get_special_line_product``
+SPECIAL_LINE_PRODUCT_FIELDS = ('name', 'uom_id')
+
+# ids of the products for which ``on_product_price_changed_batch`` has
+# already been fired, per cursor, until the end of the transaction
+_price_changed_product_ids = weakref.WeakKeyDictionary()
+
+
+def _notified_product_ids(cr):
+    """ Return the set of products already notified in the current
+    transaction of the cursor """
+    product_ids = _price_changed_product_ids.get(cr)
+    if product_ids is None:
+        product_ids = _price_changed_product_ids[cr] = set()
+        forget = partial(_price_changed_product_ids.pop, cr, None)
+        cr.after('commit', forget)
+        cr.after('rollback', forget)
+    return product_ids
 
 
 class product_template(orm.Model):
@@ -47,14 +83,20 @@ class product_template(orm.Model):
     }
 
     def _price_changed(self, cr, uid, ids, vals, context=None):
-        """ Fire the ``on_product_price_changed`` on all the variants of
-        the template if the price if the product could have changed.
+        """ Fire the ``on_product_price_changed_batch`` on all the
+        variants of the template if the price if the product could have
+        changed.
 
         If one of the field used in a sale pricelist item has been
         modified, we consider that the price could have changed.
 
         There is no guarantee that's the price actually changed,
         because it depends on the pricelists.
+
+        When the templates have more than ``VARIANTS_DEFER_THRESHOLD``
+        variants, or when the ``defer_variants_price_changed`` key is
+        set in the context, the events are fired in a job, see
+        ``template_variants_price_changed``.
         """
         if context is None:
             context = {}
@@ -67,57 +109,132 @@ class product_template(orm.Model):
         tmpl_fields = [field for field in vals if field in self._columns]
         if any(field in price_fields for field in tmpl_fields):
             product_obj = self.pool['product.product']
-            session = ConnectorSession(cr, uid, context=context)
-            product_ids = product_obj.search(cr, uid,
-                                             [('product_tmpl_id', 'in', ids)],
-                                             context=context)
-            # when the write is done on the product.product, avoid
-            # to fire the event 2 times
-            if context.get('from_product_ids'):
-                product_ids = list(set(product_ids) -
-                                   set(context['from_product_ids']))
-            for prod_id in product_ids:
-                on_product_price_changed.fire(session,
-                                              product_obj._name,
-                                              prod_id)
+            product_ids = []
+            if not context.get('defer_variants_price_changed'):
+                product_ids = product_obj.search(
+                    cr, uid,
+                    [('product_tmpl_id', 'in', ids)],
+                    limit=VARIANTS_DEFER_THRESHOLD + 1,
+                    context=context)
+            if (context.get('defer_variants_price_changed') or
+                    len(product_ids) > VARIANTS_DEFER_THRESHOLD):
+                session = ConnectorSession(cr, uid, context=context)
+                template_variants_price_changed.delay(session, self._name,
+                                                      ids)
+            else:
+                product_obj._fire_price_changed(cr, uid, product_ids,
+                                                context=context)
+
+    def _variant_ids(self, cr, ids):
+        product_obj = self.pool['product.product']
+        return product_obj.search(cr, SUPERUSER_ID,
+                                  [('product_tmpl_id', 'in', ids)],
+                                  context={'active_test': False})
 
     def write(self, cr, uid, ids, vals, context=None):
         if isinstance(ids, (int, long)):
             ids = [ids]
+        if any(field in vals for field in SPECIAL_LINE_PRODUCT_FIELDS):
+            product_obj = self.pool['product.product']
+            product_obj._clear_special_line_product_cache(
+                cr, self._variant_ids(cr, ids))
         result = super(product_template, self).write(cr, uid, ids,
                                                      vals, context=context)
         self._price_changed(cr, uid, ids, vals, context=context)
         return result
 
+    def unlink(self, cr, uid, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        product_obj = self.pool['product.product']
+        product_obj._clear_special_line_product_cache(
+            cr, self._variant_ids(cr, ids))
+        return super(product_template, self).unlink(cr, uid, ids,
+                                                    context=context)
+
+
+@job
+def template_variants_price_changed(session, model_name, template_ids,
+                                    chunk_size=VARIANTS_CHUNK_SIZE):
+    """ Fire the ``on_product_price_changed_batch`` for all the variants
+    of the templates, by chunks of ``chunk_size`` variants.
+
+    The variants are read chunk after chunk, ordered by id, so the
+    memory used does not depend on the number of variants.
+    """
+    product_obj = session.pool['product.product']
+    last_id = 0
+    count = 0
+    while True:
+        product_ids = product_obj.search(
+            session.cr, session.uid,
+            [('product_tmpl_id', 'in', template_ids),
+             ('id', '>', last_id)],
+            limit=chunk_size,
+            order='id',
+            context=session.context)
+        if not product_ids:
+            break
+        on_product_price_changed_batch.fire(session, product_obj._name,
+                                            product_ids)
+        count += len(product_ids)
+        last_id = product_ids[-1]
+        _logger.info('price changed fired for %d variants of the '
+                     'templates %s', count, template_ids)
+    return _('Price changed fired for %d variants.') % count
+
 
 class product_product(orm.Model):
     _inherit = 'product.product'
 
+    @ormcache(skiparg=3)
+    def _checkpoint_model_id(self, cr, uid):
+        """ Return the id of the ``ir.model`` of the products """
+        model_obj = self.pool['ir.model']
+        return model_obj.search(cr, SUPERUSER_ID,
+                                [('model', '=', self._name)])[0]
+
     def _get_checkpoint(self, cr, uid, ids, name, arg, context=None):
-        result = {}
-        checkpoint_obj = self.pool.get('connector.checkpoint')
-        model_obj = self.pool.get('ir.model')
-        model_id = model_obj.search(cr, uid,
-                                    [('model', '=', 'product.product')],
-                                    context=context)[0]
-        for product_id in ids:
-            point_ids = checkpoint_obj.search(cr, uid,
-                                              [('model_id', '=', model_id),
-                                               ('record_id', '=', product_id),
-                                               ('state', '=', 'need_review')],
-                                              context=context)
-            result[product_id] = bool(point_ids)
+        result = dict.fromkeys(ids, False)
+        if not ids:
+            return result
+        model_id = self._checkpoint_model_id(cr, uid)
+        cr.execute("SELECT DISTINCT record_id FROM connector_checkpoint "
+                   "WHERE model_id = %s "
+                   "AND state = 'need_review' "
+                   "AND record_id IN %s",
+                   (model_id, tuple(ids)))
+        for product_id, in cr.fetchall():
+            result[product_id] = True
         return result
 
+    def _search_checkpoint(self, cr, uid, obj, name, args, context=None):
+        model_id = self._checkpoint_model_id(cr, uid)
+        query = ("SELECT record_id FROM connector_checkpoint "
+                 "WHERE model_id = %s AND state = 'need_review'")
+        domain = []
+        for __, operator, value in args:
+            if operator not in ('=', '!='):
+                raise orm.except_orm(
+                    _('Error'),
+                    _('Operator %s is not supported for the field '
+                      'Has Checkpoint') % operator)
+            if (operator == '=') == bool(value):
+                domain.append(('id', 'inselect', (query, (model_id,))))
+            else:
+                domain.append(('id', 'not inselect', (query, (model_id,))))
+        return domain
+
     _columns = {
         'has_checkpoint': fields.function(_get_checkpoint,
+                                          fnct_search=_search_checkpoint,
                                           type='boolean',
                                           readonly=True,
                                           string='Has Checkpoint'),
     }
 
     def _price_changed(self, cr, uid, ids, vals, context=None):
-        """ Fire the ``on_product_price_changed`` if the price
+        """ Fire the ``on_product_price_changed_batch`` if the price
         if the product could have changed.
 
         If one of the field used in a sale pricelist item has been
@@ -129,22 +246,83 @@ class product_product(orm.Model):
         type_obj = self.pool['product.price.type']
         price_fields = type_obj.sale_price_fields(cr, uid, context=context)
         if any(field in price_fields for field in vals):
-            session = ConnectorSession(cr, uid, context=context)
-            for prod_id in ids:
-                on_product_price_changed.fire(session, self._name, prod_id)
+            self._fire_price_changed(cr, uid, ids, context=context)
+
+    def _fire_price_changed(self, cr, uid, ids, context=None):
+        """ Fire the ``on_product_price_changed_batch`` for the products
+        which have not been notified yet in the current transaction.
+
+        A product can be modified several times in a transaction
+        (create then write, write on the variant then on the template,
+        ...). The listeners delay jobs which read the product when they
+        are executed, so the event is fired only once per product and
+        per transaction.
+        """
+        notified_ids = _notified_product_ids(cr)
+        product_ids = [product_id for product_id in ids
+                       if product_id not in notified_ids]
+        if not product_ids:
+            return
+        notified_ids.update(product_ids)
+        session = ConnectorSession(cr, uid, context=context)
+        on_product_price_changed_batch.fire(session, self._name, product_ids)
+
+    def get_special_line_product(self, cr, uid, xmlid, context=None):
+        """ Return the id, name (in the language of the context) and unit
+        of measure of the product ``xmlid``, used by the
+        ``SpecialOrderLineBuilder`` to build the shipping, cash on
+        delivery, gift lines, ...
+
+        The result is cached per database, xmlid and language, the cache
+        is cleared when the name or unit of measure of a product having
+        an xmlid is modified, and when the transaction which modified it
+        is rolled back.
+
+        :param xmlid: xmlid of the product (``module.name``)
+        :return: tuple ``(id, name, uom_id)``
+        """
+        lang = (context or {}).get('lang') or False
+        return self._special_line_product(cr, uid, xmlid, lang)
+
+    @ormcache(skiparg=3)
+    def _special_line_product(self, cr, uid, xmlid, lang):
+        data_obj = self.pool['ir.model.data']
+        product_id = data_obj.xmlid_to_res_id(cr, SUPERUSER_ID, xmlid,
+                                              raise_if_not_found=True)
+        product = self.browse(cr, SUPERUSER_ID, product_id,
+                              context={'lang': lang})
+        return (product.id, product.name, product.uom_id.id)
+
+    def _clear_special_line_product_cache(self, cr, ids):
+        """ Clear the cache of ``get_special_line_product`` when one of
+        the products has an xmlid """
+        if not ids:
+            return
+        cr.execute("SELECT 1 FROM ir_model_data "
+                   "WHERE model = %s AND res_id IN %s LIMIT 1",
+                   (self._name, tuple(ids)))
+        if cr.fetchone():
+            self.clear_caches()
+            # do not keep the values of a rolled back transaction
+            cr.after('rollback', self.clear_caches)
 
     def write(self, cr, uid, ids, vals, context=None):
-        if context is None:
-            context = {}
         if isinstance(ids, (int, long)):
             ids = [ids]
-        context = context.copy()
-        context['from_product_ids'] = ids
+        if any(field in vals for field in SPECIAL_LINE_PRODUCT_FIELDS):
+            self._clear_special_line_product_cache(cr, ids)
         result = super(product_product, self).write(
             cr, uid, ids, vals, context=context)
         self._price_changed(cr, uid, ids, vals, context=context)
         return result
 
+    def unlink(self, cr, uid, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        self._clear_special_line_product_cache(cr, ids)
+        return super(product_product, self).unlink(cr, uid, ids,
+                                                   context=context)
+
     def create(self, cr, uid, vals, context=None):
         product_ids = super(product_product, self).create(
             cr, uid, vals, context=context)
@@ -166,14 +344,87 @@ class product_price_type(orm.Model):
         """ Returns a list of fields used by sale pricelists.
         Used to know if the sale price could have changed
         when one of these fields has changed.
+
+        The result is cached per database and company, the cache is
+        cleared when a price type or a pricelist (items, versions) is
+        modified, and when the transaction which modified them is rolled
+        back.
         """
+        user_obj = self.pool['res.users']
+        company_id = user_obj._get_company(cr, uid, context=context)
+        return list(self._sale_price_fields(cr, uid, company_id))
+
+    @ormcache(skiparg=3)
+    def _sale_price_fields(self, cr, uid, company_id):
         item_obj = self.pool['product.pricelist.item']
         item_ids = item_obj.search(
-            cr, uid,
-            [('price_version_id.pricelist_id.type', '=', 'sale')],
-            context=context)
-        type_ids = self.search(cr, uid,
-                               [('pricelist_item_ids', 'in', item_ids)],
-                               context=context)
-        types = self.read(cr, uid, type_ids, ['field'], context=context)
-        return [t['field'] for t in types]
+            cr, SUPERUSER_ID,
+            [('price_version_id.pricelist_id.type', '=', 'sale'),
+             '|',
+             ('price_version_id.pricelist_id.company_id', '=', False),
+             ('price_version_id.pricelist_id.company_id', '=', company_id)])
+        type_ids = self.search(cr, SUPERUSER_ID,
+                               [('pricelist_item_ids', 'in', item_ids)])
+        types = self.read(cr, SUPERUSER_ID, type_ids, ['field'])
+        return tuple(t['field'] for t in types)
+
+    def _clear_sale_price_fields_cache(self, cr):
+        """ Clear the cache of ``sale_price_fields``, again if the
+        transaction is rolled back, so the cache does not keep the
+        fields of a rolled back transaction """
+        self.clear_caches()
+        cr.after('rollback', self.clear_caches)
+
+    def create(self, cr, uid, vals, context=None):
+        self._clear_sale_price_fields_cache(cr)
+        return super(product_price_type, self).create(cr, uid, vals,
+                                                      context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        self._clear_sale_price_fields_cache(cr)
+        return super(product_price_type, self).write(cr, uid, ids, vals,
+                                                     context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        self._clear_sale_price_fields_cache(cr)
+        return super(product_price_type, self).unlink(cr, uid, ids,
+                                                      context=context)
+
+
+class PriceFieldsCacheInvalidator(object):
+    """ Clear the cache of ``product_price_type.sale_price_fields``
+    when a record of the model is modified.
+
+    The registry signals the cleared caches to the other workers.
+    """
+
+    def _clear_sale_price_fields_cache(self, cr):
+        type_obj = self.pool['product.price.type']
+        type_obj._clear_sale_price_fields_cache(cr)
+
+    def create(self, cr, uid, vals, context=None):
+        self._clear_sale_price_fields_cache(cr)
+        return super(PriceFieldsCacheInvalidator, self).create(
+            cr, uid, vals, context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        self._clear_sale_price_fields_cache(cr)
+        return super(PriceFieldsCacheInvalidator, self).write(
+            cr, uid, ids, vals, context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        self._clear_sale_price_fields_cache(cr)
+        return super(PriceFieldsCacheInvalidator, self).unlink(
+            cr, uid, ids, context=context)
+
+
+class product_pricelist(PriceFieldsCacheInvalidator, orm.Model):
+    _inherit = 'product.pricelist'
+
+
+class product_pricelist_version(PriceFieldsCacheInvalidator, orm.Model):
+    _inherit = 'product.pricelist.version'
+
+
+class product_pricelist_item(PriceFieldsCacheInvalidator, orm.Model):
+    _inherit = 'product.pricelist.item'
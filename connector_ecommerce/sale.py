@@ -23,14 +23,34 @@
 
 import logging
 
-from openerp import models
+from openerp import SUPERUSER_ID, api, models
 from openerp.osv import orm, fields, osv
 from openerp.tools.translate import _
-from openerp import netsvc
 from openerp.addons.connector.connector import ConnectorUnit
+from openerp.addons.connector.queue.job import job
+from openerp.addons.connector.session import ConnectorSession
+from .unit.sale_order_onchange import (has_onchange_caches,
+                                       invalidate_onchange_caches)
 
 _logger = logging.getLogger(__name__)
 
+# number of sales orders processed by a job after a mass cancellation
+# with ``sale_order.mark_canceled_in_backend``
+CANCELED_IN_BACKEND_CHUNK_SIZE = 100
+
+# code of the sales exceptions of this module which are evaluated with
+# one query for a batch of sales orders, see
+# ``sale_order._get_connector_exceptions_failing_ids``
+CONNECTOR_EXCEPTIONS_CODE = {
+    'excep_order_need_cancel': "if order.need_cancel:\n"
+                               "    failed = True",
+    'excep_parent_order_need_cancel': "if order.parent_need_cancel:\n"
+                                      "    failed = True",
+    'excep_product_has_checkpoint': "if object.product_id and "
+                                    "object.product_id.has_checkpoint:\n"
+                                    "    failed = True",
+}
+
 
 class sale_order(orm.Model):
     """ Add a cancellation mecanism in the sales orders
@@ -55,16 +75,137 @@ class sale_order(orm.Model):
     """
     _inherit = 'sale.order'
 
-    def _get_parent_id(self, cr, uid, ids, name, arg, context=None):
-        return self.get_parent_id(cr, uid, ids, context=context)
-
     def get_parent_id(self, cr, uid, ids, context=None):
-        """ Need to be inherited in the connectors to implement the
-        parent logic.
-
+        """ Return a dict with the id of the parent sales order of each
+        sales order.
+
+        The parent is stored in ``parent_id``, the connectors should
+        write it when they import a sales order which replaces another
+        one. The connectors which inherit this method to implement the
+        parent logic instead have to call ``_sync_parent_id`` after
+        their imports, ``parent_id`` is otherwise only updated with the
+        result of this method before the exceptions of the sales orders
+        are detected.
         See an implementation example in ``magentoerpconnect``.
         """
-        return dict.fromkeys(ids, False)
+        return dict((order['id'],
+                     order['parent_id'] and order['parent_id'][0])
+                    for order in self.read(cr, uid, ids, ['parent_id'],
+                                           context=context))
+
+    def _sync_parent_id(self, cr, uid, ids, context=None):
+        """ Store in ``parent_id`` the parents returned by
+        ``get_parent_id`` """
+        if not ids:
+            return
+        parents = self.get_parent_id(cr, uid, ids, context=context)
+        cr.execute("SELECT id, parent_id FROM sale_order WHERE id IN %s",
+                   (tuple(ids),))
+        current_parents = dict(cr.fetchall())
+        ids_by_parent = {}
+        for order_id, parent_id in parents.iteritems():
+            if (parent_id or None) != current_parents.get(order_id):
+                ids_by_parent.setdefault(parent_id or False,
+                                         []).append(order_id)
+        for parent_id, order_ids in ids_by_parent.iteritems():
+            self.write(cr, uid, order_ids, {'parent_id': parent_id},
+                       context=context)
+
+    def get_child_ids(self, cr, uid, ids, context=None):
+        """ Return a dict with the list of the direct children sales
+        orders of each sales order.
+        """
+        result = dict((order_id, []) for order_id in ids)
+        if not ids:
+            return result
+        cr.execute("SELECT parent_id, id FROM sale_order "
+                   "WHERE parent_id IN %s ORDER BY id",
+                   (tuple(ids),))
+        for parent_id, order_id in cr.fetchall():
+            result[parent_id].append(order_id)
+        return result
+
+    def get_ancestor_ids(self, cr, uid, ids, context=None):
+        """ Return a dict with the list of the ancestors of each sales
+        order, from the root to the direct parent.
+
+        The ancestors are read in the materialized path of the parent
+        (``parent_path``), so it is a single query.
+        """
+        result = dict((order_id, []) for order_id in ids)
+        if not ids:
+            return result
+        cr.execute("SELECT o.id, o.parent_id, p.parent_path "
+                   "FROM sale_order o "
+                   "JOIN sale_order p ON p.id = o.parent_id "
+                   "WHERE o.id IN %s",
+                   (tuple(ids),))
+        for order_id, parent_id, parent_path in cr.fetchall():
+            if not parent_path:
+                parent_path = '%d/' % parent_id
+            result[order_id] = [int(ancestor_id) for ancestor_id
+                                in parent_path.split('/') if ancestor_id]
+        return result
+
+    def get_descendant_ids(self, cr, uid, ids, context=None):
+        """ Return the ids of all the descendants of the sales orders
+
+        The descendants are searched on the materialized path
+        (``parent_path``) with one query, using its index.
+        """
+        if not ids:
+            return []
+        cr.execute("SELECT parent_path FROM sale_order "
+                   "WHERE id IN %s AND parent_path IS NOT NULL",
+                   (tuple(ids),))
+        paths = [path + '_%' for path, in cr.fetchall()]
+        if not paths:
+            return []
+        cr.execute("SELECT id FROM sale_order "
+                   "WHERE parent_path LIKE ANY(%s)",
+                   (paths,))
+        return [order_id for order_id, in cr.fetchall()]
+
+    def _update_parent_path(self, cr, uid, ids, parent_id, context=None):
+        """ Update the materialized path of the sales orders and their
+        descendants for a new parent.
+
+        It is called before the write of ``parent_id``, so the paths
+        are up to date when the stored fields are recomputed.
+        """
+        parent_path = ''
+        if parent_id:
+            cr.execute("SELECT parent_path FROM sale_order WHERE id = %s",
+                       (parent_id,))
+            parent_path = cr.fetchone()[0] or '%d/' % parent_id
+        for order_id in ids:
+            if ('/%d/' % order_id) in '/' + parent_path:
+                raise orm.except_orm(
+                    _('Error'),
+                    _('You cannot create recursive sales orders.'))
+            cr.execute("SELECT parent_path FROM sale_order WHERE id = %s",
+                       (order_id,))
+            old_path = cr.fetchone()[0]
+            new_path = '%s%d/' % (parent_path, order_id)
+            if old_path:
+                cr.execute("UPDATE sale_order "
+                           "SET parent_path = %s || substr(parent_path, %s) "
+                           "WHERE parent_path LIKE %s",
+                           (new_path, len(old_path) + 1, old_path + '%'))
+            else:
+                cr.execute("UPDATE sale_order SET parent_path = %s "
+                           "WHERE id = %s",
+                           (new_path, order_id))
+        self.invalidate_cache(cr, uid, ['parent_path'], context=context)
+
+    def _get_order_and_descendant_ids(self, cr, uid, ids, context=None):
+        """ Return the ids and the ids of all the descendants of the
+        sales orders, used as store trigger for ``parent_need_cancel``
+        """
+        order_obj = self.pool['sale.order']
+        descendant_ids = order_obj.get_descendant_ids(cr, uid, ids,
+                                                      context=context)
+        return list(set(ids) | set(descendant_ids))
 
     def _get_need_cancel(self, cr, uid, ids, name, arg, context=None):
         result = {}
@@ -74,11 +215,7 @@ class sale_order(orm.Model):
         return result
 
     def _get_parent_need_cancel(self, cr, uid, ids, name, arg, context=None):
-        result = {}
-        for order in self.browse(cr, uid, ids, context=context):
-            result[order.id] = self._parent_need_cancel(cr, uid, order,
-                                                        context=context)
-        return result
+        return self._parents_need_cancel(cr, uid, ids, context=context)
 
     _columns = {
         'canceled_in_backend': fields.boolean('Canceled in backend',
@@ -88,25 +225,87 @@ class sale_order(orm.Model):
         # because the user manually chosed to keep it open
         'cancellation_resolved': fields.boolean('Cancellation from the '
                                                 'backend resolved'),
-        'parent_id': fields.function(_get_parent_id,
+        'parent_id': fields.many2one('sale.order',
                                      string='Parent Order',
-                                     type='many2one',
+                                     readonly=True,
+                                     select=True,
+                                     ondelete='set null',
+                                     copy=False,
                                      help='A parent sales order is a sales '
-                                          'order replaced by this one.',
-                                     relation='sale.order'),
-        'need_cancel': fields.function(_get_need_cancel,
-                                       string='Need to be canceled',
-                                       type='boolean',
-                                       help='Has been canceled on the backend'
-                                            ', need to be canceled.'),
+                                          'order replaced by this one.'),
+        # ids of the ancestors and of the sales order, separated and
+        # ended by slashes: 12/35/40/
+        'parent_path': fields.char('Parent Path', readonly=True,
+                                   copy=False),
+        'need_cancel': fields.function(
+            _get_need_cancel,
+            string='Need to be canceled',
+            type='boolean',
+            store={
+                'sale.order': (lambda self, cr, uid, ids, c=None: ids,
+                               ['canceled_in_backend',
+                                'cancellation_resolved'],
+                               10),
+            },
+            help='Has been canceled on the backend'
+                 ', need to be canceled.'),
         'parent_need_cancel': fields.function(
             _get_parent_need_cancel,
             string='A parent sales orders needs cancel',
             type='boolean',
+            store={
+                'sale.order': (_get_order_and_descendant_ids,
+                               ['canceled_in_backend',
+                                'cancellation_resolved',
+                                'parent_id'],
+                               20),
+            },
             help='A parent sales orders has been canceled on the backend'
                  ' and needs to be canceled.'),
     }
 
+    def init(self, cr):
+        """ Create partial indexes on the sales orders which need to be
+        canceled, used by the exceptions and the 'to cancel' filter,
+        and the index on the materialized path of the parents.
+        """
+        indexes = [
+            ('sale_order_need_cancel_index',
+             "CREATE INDEX sale_order_need_cancel_index "
+             "ON sale_order (state) WHERE need_cancel IS TRUE"),
+            ('sale_order_parent_need_cancel_index',
+             "CREATE INDEX sale_order_parent_need_cancel_index "
+             "ON sale_order (state) WHERE parent_need_cancel IS TRUE"),
+            ('sale_order_parent_path_index',
+             "CREATE INDEX sale_order_parent_path_index "
+             "ON sale_order (parent_path text_pattern_ops)"),
+        ]
+        for index_name, query in indexes:
+            cr.execute("SELECT indexname FROM pg_indexes "
+                       "WHERE indexname = %s", (index_name,))
+            if not cr.fetchone():
+                cr.execute(query)
+        cr.execute("UPDATE sale_order SET parent_path = id || '/' "
+                   "WHERE parent_path IS NULL AND parent_id IS NULL")
+
+    def recompute_need_cancel(self, cr, uid, ids, context=None):
+        """ Recompute the stored fields ``need_cancel`` and
+        ``parent_need_cancel`` of the sales orders and their
+        descendants.
+
+        The connectors have to call it when they modify the sales
+        orders without using the ORM.
+        """
+        if not ids:
+            return
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        order_ids = self._get_order_and_descendant_ids(cr, uid, ids,
+                                                       context=context)
+        fnames = ['need_cancel', 'parent_need_cancel']
+        self._store_set_values(cr, uid, order_ids, fnames, context)
+        self.invalidate_cache(cr, uid, fnames, order_ids, context=context)
+
     def _need_cancel(self, cr, uid, order, context=None):
         """ Return True if the sales order need to be canceled
         (has been canceled on the Backend) """
@@ -117,92 +316,254 @@ class sale_order(orm.Model):
         be canceled (has been canceled on the backend).
         Follows all the parent sales orders.
         """
-        def need_cancel(order):
-            if self._need_cancel(cr, uid, order, context=context):
-                return True
-            if order.parent_id:
-                return need_cancel(order.parent_id)
-            else:
-                return False
-        if not order.parent_id:
-            return False
-        return need_cancel(order.parent_id)
+        result = self._parents_need_cancel(cr, uid, [order.id],
+                                           context=context)
+        return result[order.id]
+
+    def _parents_need_cancel(self, cr, uid, ids, context=None):
+        """ Return a dict with, for each sales order, True if at least
+        one parent sales order need to be canceled.
+
+        The ancestors of all the sales orders are read in their
+        materialized path and their stored ``need_cancel`` are read
+        together, so it costs two queries whatever the depth.
+        """
+        ancestors = self.get_ancestor_ids(cr, uid, ids, context=context)
+        ancestor_ids = set()
+        for order_ancestor_ids in ancestors.itervalues():
+            ancestor_ids.update(order_ancestor_ids)
+        need_cancel_ids = set()
+        if ancestor_ids:
+            cr.execute("SELECT id FROM sale_order "
+                       "WHERE id IN %s AND need_cancel IS TRUE",
+                       (tuple(ancestor_ids),))
+            need_cancel_ids = set(order_id for order_id, in cr.fetchall())
+        return dict((order_id,
+                     any(ancestor_id in need_cancel_ids
+                         for ancestor_id in ancestors[order_id]))
+                    for order_id in ids)
+
+    def _cancel_orders(self, cr, uid, ids, cancel, context=None):
+        """ Cancel the sales orders with the function ``cancel``, which
+        receives a list of ids.
+
+        The sales orders are canceled together in a savepoint. If it
+        fails, they are canceled one by one so a sales order which can't
+        be canceled doesn't prevent the cancellation of the others.
+
+        :return: a tuple with the list of the canceled ids and the list
+                 of the ids which could not be canceled
+        """
+        try:
+            with cr.savepoint():
+                cancel(ids)
+        except osv.except_osv:
+            # the cache still holds the values written and read by the
+            # rolled back cancellation, on the sales orders and on the
+            # other records it touched (pickings, invoices, ...)
+            self.invalidate_cache(cr, uid, context=context)
+            if len(ids) == 1:
+                return [], list(ids)
+        else:
+            return list(ids), []
+        canceled_ids = []
+        failed_ids = []
+        for order_id in ids:
+            canceled, failed = self._cancel_orders(cr, uid, [order_id],
+                                                   cancel, context=context)
+            canceled_ids += canceled
+            failed_ids += failed
+        return canceled_ids, failed_ids
 
     def _try_auto_cancel(self, cr, uid, ids, context=None):
         """ Try to automatically cancel a sales order canceled
         in a backend.
 
         If it can't cancel it, does nothing.
+
+        The states of the sales orders are read at once and the sales
+        orders are canceled by groups of states.
         """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
         wkf_states = ('draft', 'sent')
         action_states = ('manual', 'progress')
-        wf_service = netsvc.LocalService("workflow")
         resolution_msg = _("<p>Resolution:<ol>"
                            "<li>Cancel the linked invoices, delivery "
                            "orders, automatic payments.</li>"
                            "<li>Cancel the sales order manually.</li>"
                            "</ol></p>")
-        for order_id in ids:
-            state = self.read(cr, uid, order_id,
-                              ['state'], context=context)['state']
+        canceled_msg = _("The sales order has been automatically canceled.")
+        # the 'cancellation_resolved' flag will stay to False
+        failed_msg = _("The sales order could not be automatically "
+                       "canceled.") + resolution_msg
+        done_msg = _("The sales order cannot be automatically "
+                     "canceled because it is already done.")
+        # shipping_except, invoice_except, ...
+        # can not be canceled from the view, so assume that it
+        # should not be canceled here neiter, exception to
+        # resolve
+        other_state_msg = _("The sales order could not be automatically "
+                            "canceled for this status.") + resolution_msg
+
+        ids_by_state = {}
+        for order in self.read(cr, uid, ids, ['state'], context=context):
+            ids_by_state.setdefault(order['state'], []).append(order['id'])
+
+        # respect the same cancellation methods than
+        # the sales order view: quotations use the workflow
+        # action, sales orders use the action_cancel method.
+        wkf_ids = []
+        action_ids = []
+        messages = []
+        for state, order_ids in ids_by_state.iteritems():
             if state == 'cancel':
                 continue
             elif state == 'done':
-                message = _("The sales order cannot be automatically "
-                            "canceled because it is already done.")
-            elif state in wkf_states + action_states:
-                try:
-                    # respect the same cancellation methods than
-                    # the sales order view: quotations use the workflow
-                    # action, sales orders use the action_cancel method.
-                    if state in wkf_states:
-                        wf_service.trg_validate(uid, 'sale.order',
-                                                order_id, 'cancel', cr)
-                    elif state in action_states:
-                        self.action_cancel(cr, uid, order_id, context=context)
-                    else:
-                        raise ValueError('%s should not fall here.' % state)
-                except osv.except_osv:
-                    # the 'cancellation_resolved' flag will stay to False
-                    message = _("The sales order could not be automatically "
-                                "canceled.") + resolution_msg
-                else:
-                    message = _("The sales order has been automatically "
-                                "canceled.")
+                messages += [(order_id, done_msg) for order_id in order_ids]
+            elif state in wkf_states:
+                wkf_ids += order_ids
+            elif state in action_states:
+                action_ids += order_ids
             else:
-                # shipping_except, invoice_except, ...
-                # can not be canceled from the view, so assume that it
-                # should not be canceled here neiter, exception to
-                # resolve
-                message = _("The sales order could not be automatically "
-                            "canceled for this status.") + resolution_msg
-            self.message_post(cr, uid, [order_id], body=message,
-                              context=context)
+                messages += [(order_id, other_state_msg)
+                             for order_id in order_ids]
+
+        def cancel_wkf(order_ids):
+            self.signal_workflow(cr, uid, order_ids, 'cancel')
+
+        def cancel_action(order_ids):
+            self.action_cancel(cr, uid, order_ids, context=context)
+
+        for order_ids, cancel in ((wkf_ids, cancel_wkf),
+                                  (action_ids, cancel_action)):
+            if not order_ids:
+                continue
+            canceled_ids, failed_ids = self._cancel_orders(
+                cr, uid, order_ids, cancel, context=context)
+            messages += [(order_id, canceled_msg)
+                         for order_id in canceled_ids]
+            messages += [(order_id, failed_msg) for order_id in failed_ids]
+        self._post_messages(cr, uid, self._name, messages, context=context)
+
+    def _post_messages(self, cr, uid, model_name, messages, context=None):
+        """ Post notes on many records at once
+
+        ``message_post`` accepts only one record per call and reads
+        again the author, the name, the reply-to address and the parent
+        message of the record for each message. Here, they are read
+        once for all the messages and the messages are created with
+        ``mail.message``'s ``create``. As with ``message_post`` for
+        notes without subtype, the followers are not notified and
+        ``message_last_post`` is not modified.
+
+        :param model_name: model of the records
+        :param messages: list of tuples ``(record id, body)``
+        """
+        if not messages:
+            return
+        model_obj = self.pool[model_name]
+        message_obj = self.pool['mail.message']
+        user_obj = self.pool['res.users']
+        res_ids = list(set(res_id for res_id, __ in messages))
+        author_id = user_obj.browse(cr, uid, uid,
+                                    context=context).partner_id.id
+        email_from = message_obj._get_default_from(cr, uid, context=context)
+        names = dict(model_obj.name_get(cr, uid, res_ids, context=context))
+        reply_to = model_obj.message_get_reply_to(cr, uid, res_ids,
+                                                  context=context)
+        # as message_post, the messages are answers to the first
+        # message of their thread
+        cr.execute("SELECT DISTINCT ON (res_id) res_id, id "
+                   "FROM mail_message "
+                   "WHERE model = %s AND res_id IN %s "
+                   "ORDER BY res_id, id",
+                   (model_name, tuple(res_ids)))
+        parent_ids = dict(cr.fetchall())
+        for res_id, body in messages:
+            values = {'model': model_name,
+                      'res_id': res_id,
+                      'body': body,
+                      'type': 'notification',
+                      'author_id': author_id,
+                      'email_from': email_from,
+                      'reply_to': reply_to.get(res_id),
+                      'record_name': names.get(res_id),
+                      'parent_id': parent_ids.get(res_id),
+                      }
+            message_id = message_obj.create(cr, uid, values, context=context)
+            parent_ids.setdefault(res_id, message_id)
+        if 'message_ids' in model_obj._fields:
+            model_obj.invalidate_cache(cr, uid, ['message_ids'], res_ids,
+                                       context=context)
+
+    def _get_documents_by_order(self, cr, uid, ids, context=None):
+        """ Return the pickings and invoices of the sales orders
+
+        :return: dict with the ids of the sales orders as keys and
+                 dicts ``{model name: list of ids}`` as values
+        """
+        result = dict((order_id, {'stock.picking': [],
+                                  'account.invoice': []})
+                      for order_id in ids)
+        if not ids:
+            return result
+        cr.execute("SELECT so.id, 'stock.picking', sp.id "
+                   "FROM sale_order so "
+                   "JOIN stock_picking sp "
+                   "ON sp.group_id = so.procurement_group_id "
+                   "WHERE so.id IN %s "
+                   "UNION ALL "
+                   "SELECT rel.order_id, 'account.invoice', rel.invoice_id "
+                   "FROM sale_order_invoice_rel rel "
+                   "WHERE rel.order_id IN %s",
+                   (tuple(ids), tuple(ids)))
+        for order_id, model_name, res_id in cr.fetchall():
+            result[order_id][model_name].append(res_id)
+        return result
 
     def _log_canceled_in_backend(self, cr, uid, ids, context=None):
+        """ Post a message on the sales orders canceled on the backend
+        and on their pickings and invoices.
+
+        The messages are notes posted with ``_post_messages``, no email
+        is sent to the followers.
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
         message = _("The sales order has been canceled on the backend.")
-        self.message_post(cr, uid, ids, body=message, context=context)
-        for order in self.browse(cr, uid, ids, context=context):
+        self._post_messages(cr, uid, self._name,
+                            [(order_id, message) for order_id in ids],
+                            context=context)
+        documents = self._get_documents_by_order(cr, uid, ids,
+                                                 context=context)
+        messages = {'stock.picking': [], 'account.invoice': []}
+        for order in self.read(cr, uid, ids, ['name'], context=context):
             message = _("Warning: the origin sales order %s has been canceled "
-                        "on the backend.") % order.name
-            if order.picking_ids:
-                picking_obj = self.pool.get('stock.picking')
-                picking_obj.message_post(cr, uid, order.picking_ids,
-                                         body=message, context=context)
-            if order.invoice_ids:
-                picking_obj = self.pool.get('account.invoice')
-                picking_obj.message_post(cr, uid, order.invoice_ids,
-                                         body=message, context=context)
+                        "on the backend.") % order['name']
+            for model_name, res_ids in documents[order['id']].iteritems():
+                messages[model_name] += [(res_id, message)
+                                         for res_id in res_ids]
+        for model_name, model_messages in messages.iteritems():
+            self._post_messages(cr, uid, model_name, model_messages,
+                                context=context)
 
     def create(self, cr, uid, values, context=None):
         order_id = super(sale_order, self).create(cr, uid, values,
                                                   context=context)
+        self._update_parent_path(cr, uid, [order_id],
+                                 values.get('parent_id'), context=context)
         if values.get('canceled_in_backend'):
             self._log_canceled_in_backend(cr, uid, [order_id], context=context)
             self._try_auto_cancel(cr, uid, [order_id], context=context)
         return order_id
 
     def write(self, cr, uid, ids, values, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if 'parent_id' in values:
+            self._update_parent_path(cr, uid, ids, values['parent_id'],
+                                     context=context)
         result = super(sale_order, self).write(cr, uid, ids, values,
                                                context=context)
         if values.get('canceled_in_backend'):
@@ -210,6 +571,121 @@ class sale_order(orm.Model):
             self._try_auto_cancel(cr, uid, ids, context=context)
         return result
 
+    def _get_connector_exceptions_failing_ids(self, cr, uid, ids,
+                                              context=None):
+        """ Evaluate the sales exceptions of this module for a batch of
+        sales orders, with one query per exception.
+
+        An exception whose code has been modified is not evaluated
+        here, it is left to the evaluation of ``sale_exceptions``.
+
+        :return: dict with the ids of the exceptions as keys and the
+                 sets of the ids of the failing sales orders as values
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if not ids:
+            return {}
+        data_obj = self.pool['ir.model.data']
+        exception_obj = self.pool['sale.exception']
+        rule_ids = {}
+        for name in CONNECTOR_EXCEPTIONS_CODE:
+            rule_id = data_obj.xmlid_to_res_id(
+                cr, SUPERUSER_ID, 'connector_ecommerce.%s' % name)
+            if rule_id:
+                rule_ids[rule_id] = name
+        rules = exception_obj.read(cr, SUPERUSER_ID, rule_ids.keys(),
+                                   ['code'], context=context)
+        product_obj = self.pool['product.product']
+        queries = {
+            'excep_order_need_cancel':
+                ("SELECT id FROM sale_order "
+                 "WHERE id IN %s AND need_cancel IS TRUE",
+                 (tuple(ids),)),
+            'excep_parent_order_need_cancel':
+                ("SELECT id FROM sale_order "
+                 "WHERE id IN %s AND parent_need_cancel IS TRUE",
+                 (tuple(ids),)),
+            'excep_product_has_checkpoint':
+                ("SELECT DISTINCT line.order_id "
+                 "FROM sale_order_line line "
+                 "JOIN connector_checkpoint checkpoint "
+                 "ON checkpoint.record_id = line.product_id "
+                 "WHERE line.order_id IN %s "
+                 "AND checkpoint.model_id = %s "
+                 "AND checkpoint.state = 'need_review'",
+                 (tuple(ids), product_obj._checkpoint_model_id(cr, uid))),
+        }
+        result = {}
+        for rule in rules:
+            name = rule_ids[rule['id']]
+            code = ' '.join(CONNECTOR_EXCEPTIONS_CODE[name].split())
+            if ' '.join((rule['code'] or '').split()) != code:
+                continue
+            query, params = queries[name]
+            cr.execute(query, params)
+            result[rule['id']] = set(order_id for order_id, in cr.fetchall())
+        return result
+
+    @api.multi
+    def detect_exceptions(self):
+        # the parents of the connectors inheriting ``get_parent_id``
+        # may have changed since their import
+        self._sync_parent_id()
+        failing_ids = self._get_connector_exceptions_failing_ids()
+        orders = self.with_context(
+            connector_exceptions_failing_ids=failing_ids)
+        return super(sale_order, orders).detect_exceptions()
+
+    @api.model
+    def _rule_eval(self, rule, obj_name, rec):
+        failing_ids = self.env.context.get('connector_exceptions_failing_ids')
+        if failing_ids and rule.id in failing_ids:
+            if rec._name == 'sale.order.line':
+                return rec.order_id.id in failing_ids[rule.id]
+            return rec.id in failing_ids[rule.id]
+        return super(sale_order, self)._rule_eval(rule, obj_name, rec)
+
+    def mark_canceled_in_backend(self, cr, uid, ids, context=None):
+        """ Flag sales orders as canceled in the backend, in mass
+
+        Unlike a write of ``canceled_in_backend``, the flag is set with
+        one SQL update, the stored fields depending on it are
+        recomputed with ``recompute_need_cancel`` and the logging and
+        the automatic cancellation are delayed in jobs, by chunks of
+        ``CANCELED_IN_BACKEND_CHUNK_SIZE`` sales orders.
+
+        The sales orders already canceled in the backend are ignored.
+
+        :return: the ids of the sales orders flagged
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if not ids:
+            return []
+        self.check_access_rights(cr, uid, 'write')
+        self.check_access_rule(cr, uid, ids, 'write', context=context)
+        cr.execute("UPDATE sale_order "
+                   "SET canceled_in_backend = TRUE, "
+                   "    write_uid = %s, "
+                   "    write_date = (now() at time zone 'UTC') "
+                   "WHERE id IN %s "
+                   "AND canceled_in_backend IS NOT TRUE "
+                   "RETURNING id",
+                   (uid, tuple(ids)))
+        order_ids = [order_id for order_id, in cr.fetchall()]
+        self.invalidate_cache(cr, uid,
+                              ['canceled_in_backend', 'write_uid',
+                               'write_date'],
+                              order_ids, context=context)
+        self.recompute_need_cancel(cr, uid, order_ids, context=context)
+        session = ConnectorSession(cr, uid, context=context)
+        size = CANCELED_IN_BACKEND_CHUNK_SIZE
+        for index in xrange(0, len(order_ids), size):
+            process_canceled_in_backend.delay(session, self._name,
+                                              order_ids[index:index + size])
+        return order_ids
+
     def action_cancel(self, cr, uid, ids, context=None):
         if not hasattr(ids, '__iter__'):
             ids = [ids]
@@ -273,6 +749,37 @@ class sale_order(orm.Model):
         return action
 
 
+@job
+def process_canceled_in_backend(session, model_name, order_ids):
+    """ Log the cancellation in the backend of sales orders and try to
+    cancel them automatically """
+    order_obj = session.pool[model_name]
+    order_obj._log_canceled_in_backend(session.cr, session.uid, order_ids,
+                                       context=session.context)
+    order_obj._try_auto_cancel(session.cr, session.uid, order_ids,
+                               context=session.context)
+
+
+class sale_workflow_process(orm.Model):
+    _inherit = 'sale.workflow.process'
+
+    def _invalidate_onchange_caches(self, ids):
+        if has_onchange_caches():
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            invalidate_onchange_caches('workflow_process_id', ids)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        self._invalidate_onchange_caches(ids)
+        return super(sale_workflow_process, self).write(cr, uid, ids, vals,
+                                                        context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        self._invalidate_onchange_caches(ids)
+        return super(sale_workflow_process, self).unlink(cr, uid, ids,
+                                                         context=context)
+
+
 class SpecialOrderLineBuilder(ConnectorUnit):
     """ Base class to build a sale order line for a sale order
 
@@ -308,13 +815,19 @@ class SpecialOrderLineBuilder(ConnectorUnit):
 
         product = self.product
         if product is None:
-            product = self.env.ref('.'.join(self.product_ref))
-
-        if not isinstance(product, models.BaseModel):
-            product = self.env['product.product'].browse(product)
-        return {'product_id': product.id,
-                'name': product.name,
-                'product_uom': product.uom_id.id,
+            # the product refs are resolved from a cache
+            product_id, name, uom_id = (
+                self.env['product.product'].get_special_line_product(
+                    '.'.join(self.product_ref))
+            )
+        else:
+            if not isinstance(product, models.BaseModel):
+                product = self.env['product.product'].browse(product)
+            product_id, name, uom_id = (product.id, product.name,
+                                        product.uom_id.id)
+        return {'product_id': product_id,
+                'name': name,
+                'product_uom': uom_id,
                 'product_uom_qty': self.quantity,
                 'price_unit': self.price_unit * self.sign,
                 'sequence': self.sequence}
@@ -359,3 +872,60 @@ class GiftOrderLineBuilder(SpecialOrderLineBuilder):
         if self.gift_code:
             line['name'] = "%s [%s]" % (line['name'], self.gift_code)
         return line
+
+
+def build_special_lines(connector_env, specs):
+    """ Build the special lines (shipping, cash on delivery, gift, ...)
+    of many sale orders at once
+
+    One builder is instantiated per builder class and the products of
+    the lines are read once for all the lines.
+
+    Usage::
+
+        lines = build_special_lines(
+            connector_env,
+            [(order_key, ShippingLineBuilder, 10.0, 1, None),
+             (order_key, GiftOrderLineBuilder, 5.0, 1, 'GIFTCODE'),
+             ])
+
+    :param connector_env: environment of the builders
+    :type: :py:class:`connector.connector.Environment`
+    :param specs: tuples ``(order_key, builder_class, price_unit,
+                  quantity, gift_code)``, the gift code is used only by
+                  the builders having a ``gift_code``
+    :type: list
+    :return: the values of the lines by order key, in the order of
+             ``specs``
+    :rtype: dict
+    """
+    builders = {}
+    for __, builder_class, __, __, __ in specs:
+        if builder_class not in builders:
+            builders[builder_class] = builder_class(connector_env)
+
+    # load the products of the builders, the product refs are resolved
+    # once by the cache of get_special_line_product
+    env = connector_env.session.env
+    product_model = env['product.product']
+    product_ids = set()
+    for builder in builders.itervalues():
+        if builder.product is None:
+            product_model.get_special_line_product(
+                '.'.join(builder.product_ref))
+        elif isinstance(builder.product, models.BaseModel):
+            product_ids.update(builder.product.ids)
+        else:
+            product_ids.add(builder.product)
+    if product_ids:
+        product_model.browse(list(product_ids)).read(['name', 'uom_id'])
+
+    lines = {}
+    for order_key, builder_class, price_unit, quantity, gift_code in specs:
+        builder = builders[builder_class]
+        builder.price_unit = price_unit
+        builder.quantity = quantity
+        if hasattr(builder, 'gift_code'):
+            builder.gift_code = gift_code
+        lines.setdefault(order_key, []).append(builder.get_line())
+    return lines
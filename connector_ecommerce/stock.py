@@ -22,7 +22,8 @@
 from openerp.osv import orm, fields
 
 from openerp.addons.connector.session import ConnectorSession
-from .event import on_picking_out_done, on_tracking_number_added
+from .event import (on_picking_out_done_batch,
+                    on_tracking_number_added_batch)
 
 
 class stock_picking(orm.Model):
@@ -40,6 +41,7 @@ class stock_picking(orm.Model):
         session = ConnectorSession(cr, uid, context=context)
         # Look if it exists a backorder, in that case call for partial
         pickings = self.browse(cr, uid, ids, context=context)
+        picking_ids = {'partial': [], 'complete': []}
         for picking in pickings:
             if picking.picking_type_id.code != 'outgoing':
                 continue
@@ -47,8 +49,12 @@ class stock_picking(orm.Model):
                 picking_method = 'partial'
             else:
                 picking_method = 'complete'
-            on_picking_out_done.fire(session, self._name,
-                                     picking.id, picking_method)
+            picking_ids[picking_method].append(picking.id)
+        for picking_method in ('partial', 'complete'):
+            if picking_ids[picking_method]:
+                on_picking_out_done_batch.fire(session, self._name,
+                                               picking_ids[picking_method],
+                                               picking_method)
         return res
 
     def copy(self, cr, uid, id, default=None, context=None):
@@ -67,6 +73,5 @@ class stock_picking(orm.Model):
                                                vals, context=context)
         if vals.get('carrier_tracking_ref'):
             session = ConnectorSession(cr, uid, context=context)
-            for record_id in ids:
-                on_tracking_number_added.fire(session, self._name, record_id)
+            on_tracking_number_added_batch.fire(session, self._name, ids)
         return res
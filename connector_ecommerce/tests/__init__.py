@@ -21,3 +21,7 @@
 
 from . import test_onchange
 from . import test_invoice_event
+from . import test_product_event
+from . import test_tax
+from . import test_special_line
+from . import test_sale_order
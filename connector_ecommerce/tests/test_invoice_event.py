@@ -58,7 +58,7 @@ class test_invoice_event(common.TransactionCase):
         assert self.invoice, "The invoice has not been created"
         wf_service = netsvc.LocalService('workflow')
         event = ('openerp.addons.connector_ecommerce.'
-                 'invoice.on_invoice_validated')
+                 'event.on_invoice_validated')
         with mock.patch(event) as event_mock:
             wf_service.trg_validate(uid, 'account.invoice',
                                     self.invoice.id, 'invoice_open', cr)
@@ -79,7 +79,7 @@ class test_invoice_event(common.TransactionCase):
         journal_id = self.get_ref('account', 'bank_journal')[1]
         pay_account_id = self.get_ref('account', 'cash')[1]
         period_id = self.get_ref('account', 'period_10')[1]
-        event = 'openerp.addons.connector_ecommerce.invoice.on_invoice_paid'
+        event = 'openerp.addons.connector_ecommerce.event.on_invoice_paid'
         with mock.patch(event) as event_mock:
             self.invoice.pay_and_reconcile(
                 pay_amount=self.invoice.amount_total,
@@ -95,3 +95,15 @@ class test_invoice_event(common.TransactionCase):
             event_mock.fire.assert_called_with(mock.ANY,
                                                'account.invoice',
                                                self.invoice.id)
+
+    def test_event_validated_batch(self):
+        """ Test if the ``on_invoice_validated_batch`` event is fired
+        with the ids of the invoices when they are validated """
+        cr, uid = self.cr, self.uid
+        event = ('openerp.addons.connector_ecommerce.'
+                 'invoice.on_invoice_validated_batch')
+        with mock.patch(event) as event_mock:
+            self.invoice_model.invoice_validate(cr, uid, [self.invoice.id])
+            event_mock.fire.assert_called_once_with(mock.ANY,
+                                                    'account.invoice',
+                                                    [self.invoice.id])
@@ -21,10 +21,15 @@
 ###############################################################################
 
 import mock
-from operator import attrgetter
+from operator import attrgetter, itemgetter
 
+import psycopg2
+from psycopg2 import errorcodes
+
+from openerp.addons.connector_ecommerce.unit import sale_order_onchange
 from openerp.addons.connector_ecommerce.unit.sale_order_onchange import (
-    SaleOrderOnChange)
+    SaleOrderOnChange, play_values_chunk)
+from openerp.addons.connector.exception import RetryableJobError
 from openerp.addons.connector.session import ConnectorSession
 from openerp.addons.connector.connector import Environment
 import openerp.tests.common as common
@@ -39,44 +44,49 @@ class test_onchange(common.TransactionCase):
     def setUp(self):
         super(test_onchange, self).setUp()
         self.session = ConnectorSession(self.cr, self.uid)
-
-    def test_play_onchange(self):
-        """ Play the onchange ConnectorUnit on a sale order """
         product_model = self.env['product.product']
         partner_model = self.env['res.partner']
         tax_model = self.env['account.tax']
-        sale_model = self.env['sale.order']
-        sale_line_model = self.env['sale.order.line']
         payment_method_model = self.env['payment.method']
 
         backend_record = mock.Mock()
-        env = Environment(backend_record, self.session, 'sale.order')
-
-        partner = partner_model.create({'name': 'seb',
-                                        'zip': '69100',
-                                        'city': 'Villeurbanne'})
-        partner_invoice = partner_model.create({'name': 'Guewen',
-                                                'zip': '1015',
-                                                'city': 'Lausanne',
-                                                'type': 'invoice',
-                                                'parent_id': partner.id})
-        tax = tax_model.create({'name': 'My Tax'})
-        product = product_model.create({'default_code': 'MyCode',
-                                        'name': 'My Product',
-                                        'weight': 15,
-                                        'taxes_id': [(6, 0, [tax.id])]})
-        payment_term = self.env.ref('account.account_payment_term_advance')
-        payment_method = payment_method_model.create({
+        self.connector_env = Environment(backend_record, self.session,
+                                         'sale.order')
+
+        self.partner = partner_model.create({'name': 'seb',
+                                             'zip': '69100',
+                                             'city': 'Villeurbanne'})
+        self.partner_invoice = partner_model.create({
+            'name': 'Guewen',
+            'zip': '1015',
+            'city': 'Lausanne',
+            'type': 'invoice',
+            'parent_id': self.partner.id,
+        })
+        self.tax = tax_model.create({'name': 'My Tax'})
+        self.product = product_model.create({
+            'default_code': 'MyCode',
+            'name': 'My Product',
+            'weight': 15,
+            'taxes_id': [(6, 0, [self.tax.id])],
+        })
+        self.payment_term = self.env.ref(
+            'account.account_payment_term_advance')
+        self.payment_method = payment_method_model.create({
             'name': 'Cash',
-            'payment_term_id': payment_term.id,
+            'payment_term_id': self.payment_term.id,
         })
 
+    def _new_order(self, name='mag_10000001'):
+        """ Return a new sale order and extra lines """
+        sale_model = self.env['sale.order']
+        sale_line_model = self.env['sale.order.line']
         order_vals = {
-            'name': 'mag_10000001',
-            'partner_id': partner.id,
-            'payment_method_id': payment_method.id,
+            'name': name,
+            'partner_id': self.partner.id,
+            'payment_method_id': self.payment_method.id,
             'order_line': [
-                (0, 0, {'product_id': product.id,
+                (0, 0, {'product_id': self.product.id,
                         'price_unit': 20,
                         'name': 'My Real Name',
                         'product_uom_qty': 1,
@@ -88,27 +98,357 @@ class test_onchange(common.TransactionCase):
         order = sale_model.new(order_vals)
 
         extra_lines = sale_line_model.new({
-            'product_id': product.id,
+            'product_id': self.product.id,
             'price_unit': 10,
             'name': 'Line 2',
             'product_uom_qty': 2,
             'sequence': 2,
         })
+        return order, extra_lines
 
-        onchange = SaleOrderOnChange(env)
-        order = onchange.play(order, order_lines=extra_lines)
-
-        self.assertEqual(order.partner_invoice_id, partner_invoice)
-        self.assertEqual(order.payment_term, payment_term)
+    def _check_order(self, order):
+        """ Check the values of a sale order after the onchanges """
+        self.assertEqual(order.partner_invoice_id, self.partner_invoice)
+        self.assertEqual(order.payment_term, self.payment_term)
         self.assertEqual(len(order.order_line), 2)
         for line in order.order_line:
             if line.sequence == 1:
                 self.assertEqual(line.name, 'My Real Name')
                 self.assertEqual(line.th_weight, 15)
-                self.assertEqual(line.tax_id, tax)
+                self.assertEqual(line.tax_id, self.tax)
             elif line.sequence == 2:
                 self.assertEqual(line.name, 'Line 2')
                 self.assertEqual(line.th_weight, 30)
-                self.assertEqual(line.tax_id, tax)
+                self.assertEqual(line.tax_id, self.tax)
             else:
                 raise AssertionError('Unexpected sequence')
+
+    def test_play_onchange(self):
+        """ Play the onchange ConnectorUnit on a sale order """
+        order, extra_lines = self._new_order()
+        onchange = SaleOrderOnChange(self.connector_env)
+        order = onchange.play(order, order_lines=extra_lines)
+        self._check_order(order)
+
+    def test_play_many_onchange(self):
+        """ Play the onchange ConnectorUnit on many sale orders """
+        orders = [self._new_order(name='mag_10000001'),
+                  self._new_order(name='mag_10000002')]
+        onchange = SaleOrderOnChange(self.connector_env)
+        orders = onchange.play_many(orders)
+        self.assertEqual(len(orders), 2)
+        for order in orders:
+            self._check_order(order)
+
+    def test_play_many_onchange_cached(self):
+        """ Play the onchange ConnectorUnit on many sale orders with
+        the cache of the onchanges """
+        orders = [self._new_order(name='mag_10000001'),
+                  self._new_order(name='mag_10000002')]
+        onchange = SaleOrderOnChange(self.connector_env)
+        orders = onchange.play_many(orders, cache_onchanges=True)
+        self.assertEqual(len(orders), 2)
+        for order in orders:
+            self._check_order(order)
+
+    def test_play_onchange_previous_lines(self):
+        """ The lines onchanges receive the lines processed before """
+        order, extra_lines = self._new_order()
+        onchange = SaleOrderOnChange(self.connector_env)
+        previous = []
+        play_line_onchange = onchange._play_line_onchange
+
+        def _play_line_onchange(line, previous_lines, order):
+            previous.append(list(previous_lines))
+            # they can be used as a recordset
+            self.assertEqual(previous_lines.env, self.env)
+            self.assertEqual(previous_lines.mapped('name'),
+                             [prev_line.name for prev_line in previous_lines])
+            self.assertEqual(len(previous_lines + line),
+                             len(previous_lines) + 1)
+            return play_line_onchange(line, previous_lines, order)
+
+        onchange._play_line_onchange = _play_line_onchange
+        order = onchange.play(order, order_lines=extra_lines)
+        self._check_order(order)
+        self.assertEqual(len(previous), 2)
+        self.assertEqual(previous[0], [])
+        self.assertEqual(len(previous[1]), 1)
+
+    def test_play_onchange_previous_lines_not_copied(self):
+        """ The lines processed before are not copied for each line, so
+        the cost of a line does not grow with the number of lines """
+        order, __ = self._new_order()
+        line_model = self.env['sale.order.line']
+        extra_lines = line_model.browse()
+        for sequence in xrange(2, 22):
+            extra_lines |= line_model.new({'product_id': self.product.id,
+                                           'name': 'Line %d' % sequence,
+                                           'product_uom_qty': 1,
+                                           'sequence': sequence,
+                                           })
+        onchange = SaleOrderOnChange(self.connector_env)
+        previous = []
+        play_line_onchange = onchange._play_line_onchange
+
+        def _play_line_onchange(line, previous_lines, order):
+            previous.append(previous_lines)
+            return play_line_onchange(line, previous_lines, order)
+
+        onchange._play_line_onchange = _play_line_onchange
+        order = onchange.play(order, order_lines=extra_lines)
+        self.assertEqual(len(order.order_line), 21)
+        # all the lines share the same list of processed lines
+        self.assertEqual(len(set(id(lines._lines) for lines in previous)), 1)
+        self.assertEqual([len(lines) for lines in previous], range(21))
+        # no recordset is built when it is not used
+        self.assertTrue(all(lines._records is None for lines in previous))
+
+    def test_play_values_onchange(self):
+        """ Play the onchange ConnectorUnit on the values of a sale
+        order """
+        order_vals = {
+            'name': 'mag_10000001',
+            'partner_id': self.partner.id,
+            'payment_method_id': self.payment_method.id,
+            'order_line': [
+                (0, 0, {'product_id': self.product.id,
+                        'price_unit': 20,
+                        'name': 'My Real Name',
+                        'product_uom_qty': 1,
+                        'sequence': 1,
+                        }
+                 ),
+            ]
+        }
+        extra_lines = [{'product_id': self.product.id,
+                        'price_unit': 10,
+                        'name': 'Line 2',
+                        'product_uom_qty': 2,
+                        'sequence': 2,
+                        }]
+        onchange = SaleOrderOnChange(self.connector_env)
+        values = onchange.play_values(order_vals, lines_vals=extra_lines)
+        self.assertEqual(values['partner_invoice_id'],
+                         self.partner_invoice.id)
+        self.assertEqual(values['payment_term'], self.payment_term.id)
+        self.assertEqual(len(values['order_line']), 2)
+        lines = sorted((vals for __, __, vals in values['order_line']),
+                       key=itemgetter('sequence'))
+        self.assertEqual(lines[0]['name'], 'My Real Name')
+        self.assertEqual(lines[0]['th_weight'], 15)
+        self.assertEqual(lines[0]['tax_id'], [(6, 0, [self.tax.id])])
+        self.assertEqual(lines[1]['name'], 'Line 2')
+        self.assertEqual(lines[1]['th_weight'], 30)
+        # the values given are not modified
+        self.assertNotIn('partner_invoice_id', order_vals)
+        self.assertNotIn('th_weight', extra_lines[0])
+        order = self.env['sale.order'].create(values)
+        self._check_order(order)
+
+    def test_skip_onchange(self):
+        """ With skip_filled_onchanges, the onchanges are not played
+        when their fields are set """
+        fiscal_position = self.env['account.fiscal.position'].create({
+            'name': 'Normal',
+        })
+        order_vals = {
+            'name': 'mag_10000001',
+            'partner_id': self.partner.id,
+            'partner_invoice_id': self.partner.id,
+            'partner_shipping_id': self.partner.id,
+            'pricelist_id': self.ref('product.list0'),
+            'fiscal_position': fiscal_position.id,
+            'payment_term': self.payment_term.id,
+            'user_id': self.uid,
+            'note': 'Note',
+            'section_id': self.ref('sales_team.section_sales_department'),
+            'carrier_id': self.ref('delivery.normal_delivery_carrier'),
+            'order_line': [
+                (0, 0, {'product_id': self.product.id,
+                        'price_unit': 20,
+                        'name': 'My Real Name',
+                        'product_uom_qty': 1,
+                        }
+                 ),
+            ]
+        }
+        onchange = SaleOrderOnChange(self.connector_env)
+        onchange.play_values(order_vals)
+        # not skipped by default
+        self.assertEqual(onchange.skipped_onchanges['partner_id'], 0)
+        self.assertEqual(onchange.executed_onchanges['partner_id'], 1)
+
+        onchange = SaleOrderOnChange(self.connector_env)
+        onchange.skip_filled_onchanges = True
+        values = onchange.play_values(order_vals)
+        self.assertEqual(values['partner_invoice_id'], self.partner.id)
+        self.assertEqual(onchange.skipped_onchanges['partner_id'], 1)
+        self.assertEqual(onchange.executed_onchanges['partner_id'], 0)
+        self.assertEqual(onchange.executed_onchanges['product_id'], 1)
+
+    def test_profile_onchange(self):
+        """ Profile the onchanges played on a sale order """
+        order, extra_lines = self._new_order()
+        onchange = SaleOrderOnChange(self.connector_env)
+        onchange.start_profiling(threshold=0)
+        onchange.play(order, order_lines=extra_lines)
+        report = onchange.stop_profiling()
+        steps = report['steps']
+        self.assertEqual(steps['order']['count'], 1)
+        self.assertEqual(steps['partner_id']['count'], 1)
+        self.assertEqual(steps['payment_method_id']['count'], 1)
+        self.assertEqual(steps['product_id']['count'], 2)
+        self.assertGreater(steps['product_id']['queries'], 0)
+        # with a threshold of 0, every step is reported as slow
+        self.assertEqual(len(report['slow']),
+                         sum(stats['count'] for stats in steps.values()))
+        self.assertEqual(onchange.get_profile_report(),
+                         {'steps': {}, 'slow': []})
+
+    def test_play_values_iter_onchange(self):
+        """ Play the onchanges on the lines of a sale order by chunks """
+        order_vals = {
+            'name': 'mag_10000001',
+            'partner_id': self.partner.id,
+            'payment_method_id': self.payment_method.id,
+        }
+        lines_vals = ({'product_id': self.product.id,
+                       'price_unit': 10,
+                       'name': 'Line %d' % index,
+                       'product_uom_qty': index,
+                       } for index in xrange(1, 6))
+        onchange = SaleOrderOnChange(self.connector_env)
+        order_vals, lines = onchange.play_values_iter(order_vals,
+                                                      lines_vals=lines_vals,
+                                                      chunk_size=2)
+        self.assertEqual(order_vals['partner_invoice_id'],
+                         self.partner_invoice.id)
+        self.assertNotIn('order_line', order_vals)
+        lines = list(lines)
+        self.assertEqual(len(lines), 5)
+        for index, line_vals in enumerate(lines, 1):
+            self.assertEqual(line_vals['th_weight'], 15 * index)
+            self.assertEqual(line_vals['tax_id'], [(6, 0, [self.tax.id])])
+
+    def test_onchange_cache_invalidation(self):
+        """ The cached results of a partner are dropped when a partner
+        of its tree is modified """
+        onchange = SaleOrderOnChange(self.connector_env)
+        calls = []
+
+        def partner_onchange():
+            calls.append(True)
+            return {}
+
+        onchange._start_onchange_caches()
+        try:
+            for __ in range(2):
+                onchange._cached_onchange('partner_id', 'key',
+                                          partner_onchange,
+                                          record_id=self.partner.id)
+            self.assertEqual(len(calls), 1)
+            self.partner_invoice.city = 'Geneva'
+            onchange._cached_onchange('partner_id', 'key',
+                                      partner_onchange,
+                                      record_id=self.partner.id)
+            self.assertEqual(len(calls), 2)
+            # the addresses of a contact are among its siblings
+            contact = self.env['res.partner'].create({
+                'name': 'Contact',
+                'parent_id': self.partner.id,
+            })
+            for __ in range(2):
+                onchange._cached_onchange('partner_id', 'key',
+                                          partner_onchange,
+                                          record_id=contact.id)
+            self.assertEqual(len(calls), 3)
+            self.partner_invoice.city = 'Lausanne'
+            onchange._cached_onchange('partner_id', 'key',
+                                      partner_onchange,
+                                      record_id=contact.id)
+            self.assertEqual(len(calls), 4)
+        finally:
+            onchange._stop_onchange_caches()
+
+    def test_play_values_many(self):
+        """ Play the onchanges on the values of many sale orders, the
+        failures do not prevent the other sale orders to be processed """
+        good_vals = {'name': 'mag_10000001',
+                     'partner_id': self.partner.id,
+                     'payment_method_id': self.payment_method.id,
+                     }
+        # a sale order needs a partner
+        bad_vals = {'name': 'mag_10000002'}
+        onchange = SaleOrderOnChange(self.connector_env)
+        results, errors = onchange.play_values_many([('order1', good_vals),
+                                                     ('order2', bad_vals)])
+        self.assertEqual(sorted(results), ['order1'])
+        self.assertEqual(results['order1']['partner_invoice_id'],
+                         self.partner_invoice.id)
+        self.assertEqual(sorted(errors), ['order2'])
+        # the sale orders are created only on demand
+        sale_model = self.env['sale.order']
+        names = ['mag_10000001', 'mag_10000002']
+        self.assertFalse(sale_model.search([('name', 'in', names)]))
+        onchange.play_values_many([('order1', good_vals),
+                                   ('order2', bad_vals)],
+                                  create_orders=True)
+        orders = sale_model.search([('name', 'in', names)])
+        self.assertEqual(orders.mapped('name'), ['mag_10000001'])
+        self.assertEqual(orders.partner_invoice_id, self.partner_invoice)
+
+    def test_play_values_many_retry(self):
+        """ The concurrency errors are raised so the job is retried """
+        class SerializationFailure(psycopg2.OperationalError):
+            pgcode = errorcodes.SERIALIZATION_FAILURE
+
+        onchange = SaleOrderOnChange(self.connector_env)
+        for error in (SerializationFailure(), RetryableJobError('retry')):
+            with mock.patch.object(onchange, 'play_values',
+                                   side_effect=error):
+                with self.assertRaises(type(error)):
+                    onchange.play_values_many([('order1', {})])
+        with mock.patch.object(onchange, 'play_values',
+                               side_effect=psycopg2.OperationalError()):
+            __, errors = onchange.play_values_many([('order1', {})])
+        self.assertEqual(sorted(errors), ['order1'])
+
+    def test_play_values_chunk(self):
+        """ Play the onchanges of a chunk of sale orders in a job """
+        onchange = SaleOrderOnChange(self.connector_env)
+        connector_env = mock.Mock()
+        connector_env.get_connector_unit.return_value = onchange
+        with mock.patch.object(sale_order_onchange, 'Environment',
+                               return_value=connector_env), \
+                mock.patch.object(onchange, 'play_values_many',
+                                  return_value=({'order1': {}},
+                                                {'order2': 'error'})):
+            result = play_values_chunk(self.session, 'sale.order',
+                                       'res.partner', self.partner.id,
+                                       [('order1', {}), ('order2', {})],
+                                       create_orders=True)
+            onchange.play_values_many.assert_called_once_with(
+                [('order1', {}), ('order2', {})], create_orders=True)
+        connector_env.get_connector_unit.assert_called_once_with(
+            SaleOrderOnChange)
+        self.assertEqual(result, {'results': {'order1': {}},
+                                  'errors': {'order2': 'error'}})
+
+    def test_delay_play_values(self):
+        """ Split the sale orders in jobs """
+        orders = dict(('order%d' % index, {'name': 'mag_%d' % index})
+                      for index in range(5))
+        onchange = SaleOrderOnChange(self.connector_env)
+        delay_path = ('openerp.addons.connector_ecommerce.unit.'
+                      'sale_order_onchange.play_values_chunk.delay')
+        with mock.patch(delay_path) as delay:
+            delay.side_effect = ['uuid1', 'uuid2', 'uuid3']
+            job_uuids = onchange.delay_play_values(orders, chunk_size=2)
+        self.assertEqual(delay.call_count, 3)
+        self.assertEqual(sorted(job_uuids), sorted(orders))
+        self.assertEqual(sorted(set(job_uuids.values())),
+                         ['uuid1', 'uuid2', 'uuid3'])
+        # the sale orders are not created by default
+        for call in delay.call_args_list:
+            self.assertFalse(call[1]['create_orders'])
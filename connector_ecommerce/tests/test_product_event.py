@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import mock
+
+import openerp.tests.common as common
+
+
+class test_product_event(common.TransactionCase):
+    """ Test if the price changed events are fired correctly """
+
+    def setUp(self):
+        super(test_product_event, self).setUp()
+        self.product_model = self.env['product.product']
+        self.event = ('openerp.addons.connector_ecommerce.'
+                      'product.on_product_price_changed_batch')
+
+    def test_event_price_changed_once(self):
+        """ ``on_product_price_changed_batch`` is fired once per
+        product and per transaction """
+        with mock.patch(self.event) as event_mock:
+            product = self.product_model.create({'name': 'Hodor',
+                                                 'list_price': 10})
+            product.write({'list_price': 20})
+            product.product_tmpl_id.write({'list_price': 30})
+            event_mock.fire.assert_called_once_with(mock.ANY,
+                                                    'product.product',
+                                                    [product.id])
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import mock
+
+from openerp.osv import orm, osv
+from openerp.addons.connector_ecommerce import sale
+import openerp.tests.common as common
+
+
+class test_sale_order_cancel(common.TransactionCase):
+    """ Test the cancellation of the sales orders canceled in a backend """
+
+    def setUp(self):
+        super(test_sale_order_cancel, self).setUp()
+        self.order_model = self.env['sale.order']
+        self.partner = self.env['res.partner'].create({'name': 'seb'})
+
+    def _create_orders(self, count, **values):
+        orders = self.order_model.browse()
+        for __ in xrange(count):
+            order_values = {'partner_id': self.partner.id}
+            order_values.update(values)
+            orders |= self.order_model.create(order_values)
+        return orders
+
+    def test_cancel_orders_one_failure(self):
+        """ An order which cannot be canceled does not prevent the
+        cancellation of the other orders of its group """
+        orders = self._create_orders(3)
+        failing = orders[1]
+
+        def cancel(order_ids):
+            self.order_model.browse(order_ids).write({'state': 'cancel'})
+            if failing.id in order_ids:
+                raise osv.except_osv('Error', 'Cannot cancel')
+
+        canceled_ids, failed_ids = orders._cancel_orders(cancel)
+        self.assertEqual(sorted(canceled_ids),
+                         sorted([orders[0].id, orders[2].id]))
+        self.assertEqual(failed_ids, [failing.id])
+        # the values written by the rolled back cancellations are not
+        # kept in the cache
+        self.assertEqual(orders.mapped('state'),
+                         ['cancel', 'draft', 'cancel'])
+
+    def test_post_messages(self):
+        """ Post notes on many sales orders at once """
+        orders = self._create_orders(2)
+        message_model = self.env['mail.message']
+        domain = [('model', '=', 'sale.order'), ('res_id', 'in', orders.ids)]
+        first_messages = {}
+        for message in message_model.search(domain, order='id'):
+            first_messages.setdefault(message.res_id, message)
+        self.order_model._post_messages(
+            'sale.order',
+            [(orders[0].id, 'Message 1'),
+             (orders[1].id, 'Message 2'),
+             (orders[0].id, 'Message 3')])
+        messages = message_model.search(domain + [('body', 'like', 'Message')],
+                                        order='id')
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(len(set(messages.mapped('message_id'))), 3)
+        no_message = message_model.browse()
+        # as with message_post, the messages answer the first message
+        # of their thread
+        expected = [
+            (orders[0], first_messages.get(orders[0].id, no_message)),
+            (orders[1], first_messages.get(orders[1].id, no_message)),
+            (orders[0], first_messages.get(orders[0].id, messages[0])),
+        ]
+        for message, (order, parent) in zip(messages, expected):
+            self.assertEqual(message.res_id, order.id)
+            self.assertEqual(message.parent_id, parent)
+            self.assertEqual(message.type, 'notification')
+            self.assertEqual(message.author_id, self.env.user.partner_id)
+            self.assertEqual(message.record_name, order.name)
+            self.assertFalse(message.subtype_id)
+            # as for a note, nobody is notified
+            self.assertFalse(message.notified_partner_ids)
+            self.assertIn(message, order.message_ids)
+
+    def test_mark_canceled_in_backend(self):
+        """ Flag sales orders as canceled in the backend in mass """
+        orders = self._create_orders(3)
+        resolved = orders[2]
+        resolved.cancellation_resolved = True
+        child = self._create_orders(1, parent_id=orders[0].id)
+        with mock.patch.object(sale, 'process_canceled_in_backend') as job, \
+                mock.patch.object(sale, 'CANCELED_IN_BACKEND_CHUNK_SIZE', 2):
+            order_ids = orders.mark_canceled_in_backend()
+            self.assertEqual(sorted(order_ids), sorted(orders.ids))
+            self.assertTrue(all(orders.mapped('canceled_in_backend')))
+            self.assertEqual(orders.mapped('need_cancel'),
+                             [True, True, False])
+            self.assertFalse(child.canceled_in_backend)
+            self.assertFalse(child.need_cancel)
+            self.assertTrue(child.parent_need_cancel)
+            # the logging and the cancellation are delayed in jobs
+            self.assertEqual(orders.mapped('state'), ['draft'] * 3)
+            chunks = [call[0][2] for call in job.delay.call_args_list]
+            self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+            self.assertEqual(sorted(sum(chunks, [])), sorted(order_ids))
+
+            job.delay.reset_mock()
+            # already flagged
+            self.assertEqual((orders | child).mark_canceled_in_backend(),
+                             [child.id])
+            self.assertEqual(job.delay.call_args_list,
+                             [mock.call(mock.ANY, 'sale.order', [child.id])])
+
+
+class test_sale_order_parent(common.TransactionCase):
+    """ Test the parents of the sales orders and their materialized
+    path """
+
+    def setUp(self):
+        super(test_sale_order_parent, self).setUp()
+        self.order_model = self.env['sale.order']
+        partner = self.env['res.partner'].create({'name': 'seb'})
+        values = {'partner_id': partner.id}
+        self.root = self.order_model.create(values)
+        self.child = self.order_model.create(
+            dict(values, parent_id=self.root.id))
+        self.grandchild = self.order_model.create(
+            dict(values, parent_id=self.child.id))
+        self.other = self.order_model.create(values)
+
+    def _path(self, *orders):
+        return ''.join('%d/' % order.id for order in orders)
+
+    def test_parent_path(self):
+        """ The path of the parents is stored on the sales orders """
+        self.assertEqual(self.root.parent_path, self._path(self.root))
+        self.assertEqual(self.child.parent_path,
+                         self._path(self.root, self.child))
+        self.assertEqual(self.grandchild.parent_path,
+                         self._path(self.root, self.child, self.grandchild))
+
+    def test_ancestors_descendants(self):
+        """ Read the ancestors and the descendants of sales orders """
+        ancestors = self.order_model.get_ancestor_ids(
+            [self.root.id, self.child.id, self.grandchild.id])
+        self.assertEqual(ancestors,
+                         {self.root.id: [],
+                          self.child.id: [self.root.id],
+                          self.grandchild.id: [self.root.id, self.child.id]})
+        descendant_ids = self.order_model.get_descendant_ids([self.root.id])
+        self.assertEqual(sorted(descendant_ids),
+                         sorted([self.child.id, self.grandchild.id]))
+        self.assertEqual(
+            self.order_model.get_descendant_ids([self.grandchild.id]), [])
+        self.assertEqual(
+            self.order_model.get_descendant_ids([self.other.id]), [])
+
+    def test_move_subtree(self):
+        """ Move a sales order with its descendants to another parent """
+        self.child.parent_id = self.other
+        self.assertEqual(self.child.parent_path,
+                         self._path(self.other, self.child))
+        self.assertEqual(self.grandchild.parent_path,
+                         self._path(self.other, self.child, self.grandchild))
+        self.assertEqual(
+            self.order_model.get_descendant_ids([self.root.id]), [])
+        self.child.parent_id = False
+        self.assertEqual(self.child.parent_path, self._path(self.child))
+        self.assertEqual(self.grandchild.parent_path,
+                         self._path(self.child, self.grandchild))
+
+    def test_recursion(self):
+        """ A sales order cannot be its own ancestor """
+        with self.assertRaises(orm.except_orm):
+            self.root.parent_id = self.grandchild
+        with self.assertRaises(orm.except_orm):
+            self.child.parent_id = self.child
+
+    def test_parent_need_cancel(self):
+        """ The descendants of a sales order canceled in the backend
+        need to be canceled """
+        # a done sales order is not automatically canceled
+        self.other.state = 'done'
+        self.other.canceled_in_backend = True
+        self.assertTrue(self.other.need_cancel)
+        self.assertFalse(self.other.parent_need_cancel)
+        self.assertFalse(self.root.parent_need_cancel)
+
+        self.child.parent_id = self.other
+        self.assertTrue(self.child.parent_need_cancel)
+        self.assertTrue(self.grandchild.parent_need_cancel)
+        self.assertFalse(self.child.need_cancel)
+
+        self.other.cancellation_resolved = True
+        self.assertFalse(self.other.need_cancel)
+        self.assertFalse(self.child.parent_need_cancel)
+        self.assertFalse(self.grandchild.parent_need_cancel)
+
+
+class test_sale_order_exception(common.TransactionCase):
+    """ Test the evaluation of the sales exceptions of the connectors
+    with one query per exception """
+
+    def setUp(self):
+        super(test_sale_order_exception, self).setUp()
+        self.order_model = self.env['sale.order']
+        partner = self.env['res.partner'].create({'name': 'seb'})
+        product_model = self.env['product.product']
+        product = product_model.create({'name': 'My Product'})
+        checkpoint_product = product_model.create({'name': 'To Review'})
+        # a checkpoint is created for a backend, there is none here
+        self.cr.execute("INSERT INTO connector_checkpoint "
+                        "(record_id, model_id, backend_id, state) "
+                        "VALUES (%s, %s, %s, 'need_review')",
+                        (checkpoint_product.id,
+                         product_model._checkpoint_model_id(),
+                         'res.partner,%d' % partner.id))
+
+        def create_order(product, **values):
+            line = {'product_id': product.id,
+                    'name': product.name,
+                    'product_uom_qty': 1,
+                    'price_unit': 10}
+            values.update(partner_id=partner.id,
+                          order_line=[(0, 0, line)])
+            return self.order_model.create(values)
+
+        self.canceled = create_order(product)
+        self.child = create_order(product, parent_id=self.canceled.id)
+        self.to_review = create_order(checkpoint_product)
+        self.other = create_order(product)
+        self.orders = (self.canceled | self.child |
+                       self.to_review | self.other)
+        with mock.patch.object(sale, 'process_canceled_in_backend'):
+            self.canceled.mark_canceled_in_backend()
+        self.rules = dict(
+            (name, self.env.ref('connector_ecommerce.%s' % name))
+            for name in ('excep_order_need_cancel',
+                         'excep_parent_order_need_cancel',
+                         'excep_product_has_checkpoint'))
+
+    def _eval(self, orders, rule):
+        """ Return the ids of the orders failing a rule with
+        ``_rule_eval`` """
+        failing_ids = set()
+        for order in orders:
+            if rule.model == 'sale.order':
+                records = [('order', order)]
+            else:
+                records = [('line', line) for line in order.order_line]
+            for obj_name, record in records:
+                if orders._rule_eval(rule, obj_name, record):
+                    failing_ids.add(order.id)
+        return failing_ids
+
+    def test_fast_path(self):
+        """ The exceptions evaluated with queries give the same result
+        as their code """
+        failing_ids = self.orders._get_connector_exceptions_failing_ids()
+        fast_orders = self.orders.with_context(
+            connector_exceptions_failing_ids=failing_ids)
+        expected = {'excep_order_need_cancel': self.canceled,
+                    'excep_parent_order_need_cancel': self.child,
+                    'excep_product_has_checkpoint': self.to_review}
+        for name, rule in self.rules.iteritems():
+            self.assertEqual(failing_ids[rule.id], set(expected[name].ids))
+            self.assertEqual(self._eval(fast_orders, rule),
+                             set(expected[name].ids))
+            # without the ids of the failing orders, the code of the
+            # rules is evaluated
+            self.assertEqual(self._eval(self.orders, rule),
+                             set(expected[name].ids))
+        self.orders.detect_exceptions()
+        for name, order in expected.iteritems():
+            self.assertIn(self.rules[name], order.exception_ids)
+        rules = self.env['sale.exception'].browse(
+            [rule.id for rule in self.rules.itervalues()])
+        self.assertFalse(self.other.exception_ids & rules)
+
+    def test_modified_rule(self):
+        """ A rule whose code has been modified is evaluated with its
+        code """
+        rule = self.rules['excep_order_need_cancel']
+        rule.code = "if order.id == %d:\n    failed = True" % self.other.id
+        failing_ids = self.orders._get_connector_exceptions_failing_ids()
+        self.assertNotIn(rule.id, failing_ids)
+        self.assertIn(self.rules['excep_parent_order_need_cancel'].id,
+                      failing_ids)
+        self.orders.detect_exceptions()
+        self.assertIn(rule, self.other.exception_ids)
+        self.assertNotIn(rule, self.canceled.exception_ids)
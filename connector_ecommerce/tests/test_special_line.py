@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import mock
+
+from openerp.addons.connector.connector import Environment
+from openerp.addons.connector.session import ConnectorSession
+from openerp.addons.connector_ecommerce.sale import (ShippingLineBuilder,
+                                                     GiftOrderLineBuilder,
+                                                     build_special_lines)
+import openerp.tests.common as common
+
+
+class test_special_line(common.TransactionCase):
+    """ Test the builders of the special sale order lines """
+
+    def setUp(self):
+        super(test_special_line, self).setUp()
+        session = ConnectorSession(self.cr, self.uid)
+        self.connector_env = Environment(mock.Mock(), session,
+                                         'sale.order.line')
+        self.shipping = self.env.ref(
+            'connector_ecommerce.product_product_shipping')
+
+    def test_shipping_line(self):
+        """ Build a shipping line """
+        builder = ShippingLineBuilder(self.connector_env)
+        builder.price_unit = 10
+        line = builder.get_line()
+        self.assertEqual(line['product_id'], self.shipping.id)
+        self.assertEqual(line['name'], self.shipping.name)
+        self.assertEqual(line['product_uom'], self.shipping.uom_id.id)
+        self.assertEqual(line['price_unit'], 10)
+        self.assertEqual(line['sequence'], 999)
+
+    def test_gift_line(self):
+        """ Build a gift line """
+        builder = GiftOrderLineBuilder(self.connector_env)
+        builder.price_unit = 10
+        builder.gift_code = 'CODE'
+        line = builder.get_line()
+        self.assertEqual(line['price_unit'], -10)
+        self.assertTrue(line['name'].endswith('[CODE]'))
+
+    def test_special_line_product_cache(self):
+        """ The product of the special lines is read again when it is
+        modified """
+        builder = ShippingLineBuilder(self.connector_env)
+        builder.price_unit = 10
+        builder.get_line()
+        self.shipping.name = 'Delivery'
+        self.assertEqual(builder.get_line()['name'], 'Delivery')
+
+    def test_build_special_lines(self):
+        """ Build the special lines of many sale orders """
+        lines = build_special_lines(
+            self.connector_env,
+            [('order1', ShippingLineBuilder, 10, 1, None),
+             ('order2', ShippingLineBuilder, 20, 1, None),
+             ('order1', GiftOrderLineBuilder, 5, 2, 'CODE'),
+             ('order2', GiftOrderLineBuilder, 5, 1, None),
+             ])
+        self.assertEqual(sorted(lines), ['order1', 'order2'])
+        self.assertEqual([line['price_unit'] for line in lines['order1']],
+                         [10, -5])
+        self.assertEqual([line['price_unit'] for line in lines['order2']],
+                         [20, -5])
+        self.assertEqual(lines['order1'][1]['product_uom_qty'], 2)
+        self.assertTrue(lines['order1'][1]['name'].endswith('[CODE]'))
+        self.assertFalse(lines['order2'][1]['name'].endswith('[CODE]'))
+        self.assertEqual(lines['order2'][0]['product_id'],
+                         self.shipping.id)
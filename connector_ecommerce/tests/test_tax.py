@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import openerp.tests.common as common
+
+
+class test_tax_from_rate(common.TransactionCase):
+    """ Test the search of the taxes from their rate """
+
+    def setUp(self):
+        super(test_tax_from_rate, self).setUp()
+        self.tax_model = self.env['account.tax']
+        self.tax = self.tax_model.create({'name': 'Rate 0.2345',
+                                          'amount': 0.2345,
+                                          'type_tax_use': 'sale',
+                                          'sequence': 1})
+        self.tax_included = self.tax_model.create({
+            'name': 'Rate 0.2345 included',
+            'amount': 0.2345,
+            'type_tax_use': 'sale',
+            'price_include': True,
+            'sequence': 1,
+        })
+
+    def test_tax_from_rate(self):
+        """ Search a tax with the exact rate then with less precision """
+        self.assertEqual(self.tax_model.get_tax_from_rate(0.2345),
+                         self.tax.id)
+        self.assertEqual(self.tax_model.get_tax_from_rate(0.2395),
+                         self.tax.id)
+        self.assertEqual(self.tax_model.get_tax_from_rate(0.2345, True),
+                         self.tax_included.id)
+        self.assertFalse(self.tax_model.get_tax_from_rate(0.2495))
+
+    def test_taxes_from_rates(self):
+        """ Search the taxes of several rates """
+        taxes = self.tax_model.get_taxes_from_rates([0.2345, 0.2495])
+        self.assertEqual(taxes, {0.2345: self.tax.id, 0.2495: False})
+
+    def test_tax_cache_invalidation(self):
+        """ The index is updated when a tax is modified """
+        self.assertEqual(self.tax_model.get_tax_from_rate(0.2345),
+                         self.tax.id)
+        self.tax.amount = 0.3456
+        self.assertFalse(self.tax_model.get_tax_from_rate(0.2345))
+        self.assertEqual(self.tax_model.get_tax_from_rate(0.3456),
+                         self.tax.id)
@@ -20,7 +20,229 @@
 #
 ##############################################################################
 
-from openerp.addons.connector.connector import ConnectorUnit
+import copy
+import itertools
+import logging
+import time
+import weakref
+from collections import Counter
+from contextlib import contextmanager
+
+import psycopg2
+
+from openerp import models
+from openerp.service.model import PG_CONCURRENCY_ERRORS_TO_RETRY
+from openerp.tools import ustr
+from openerp.tools.lru import LRU
+from openerp.addons.connector.connector import ConnectorUnit, Environment
+from openerp.addons.connector.exception import RetryableJobError
+from openerp.addons.connector.queue.job import job
+
+_logger = logging.getLogger(__name__)
+
+# maximum number of results kept per onchange when the onchanges are
+# cached, see ``SaleOrderOnChange.play_many``
+ONCHANGE_CACHE_SIZE = 1000
+
+# duration in seconds above which an onchange step is logged and
+# reported as slow when the onchanges are profiled
+ONCHANGE_SLOW_THRESHOLD = 1.0
+
+# number of sale orders processed by a job delayed by
+# ``SaleOrderOnChange.delay_play_values``
+ONCHANGE_JOB_CHUNK_SIZE = 50
+
+# number of sale order lines processed between two invalidations of the
+# cache by ``SaleOrderOnChange.play_values_iter``
+ONCHANGE_LINES_CHUNK_SIZE = 200
+
+# units currently caching the results of their onchanges, see
+# ``invalidate_onchange_caches``
+_caching_onchanges = weakref.WeakSet()
+
+
+def has_onchange_caches():
+    """ Return True when a ``SaleOrderOnChange`` caches the results of
+    its onchanges in this process """
+    return bool(_caching_onchanges)
+
+
+def invalidate_onchange_caches(name, record_ids):
+    """ Drop the results of the onchange ``name`` cached for the records
+    ``record_ids`` by the ``SaleOrderOnChange`` units of this process
+
+    Called when the partners, payment methods or workflow processes
+    used by the cached onchanges are modified.
+
+    :param name: name of the field triggering the onchange
+    :type: str
+    :param record_ids: ids of the records of the field
+    :type: list
+    """
+    for onchange in list(_caching_onchanges):
+        onchange._invalidate_onchange_cache(name, record_ids)
+
+
+def _freeze(value):
+    """ Return a hashable version of ``value``, used as key of the
+    onchanges caches """
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item))
+                            for key, item in value.iteritems()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, models.BaseModel):
+        return (value._name, tuple(value.ids))
+    return value
+
+
+class _PreviousLines(object):
+    """ Read-only view on the first ``count`` lines of a list of sale
+    order lines
+
+    Given as ``previous_lines`` to the onchanges of the lines, so the
+    lines already processed are not copied for each line of the order.
+    ``len()``, the iteration and the indexing read the list directly.
+
+    When the lines are records, ``model`` is the model of the lines and
+    the view behaves as a recordset of the lines: the other attributes
+    (``env``, ``mapped``, ``filtered``, ...) and the operators (``+``,
+    ``|``, ...) are those of a recordset built on their first use.
+    """
+
+    def __init__(self, lines, count, model=None):
+        self._lines = lines
+        self._count = count
+        self._model = model
+        self._records = None
+
+    def _recordset(self):
+        if self._model is None:
+            raise TypeError('The previous lines are not records')
+        if self._records is None:
+            self._records = self._model.browse(self.ids)
+        return self._records
+
+    def __getattr__(self, name):
+        if name.startswith('__') or self._model is None:
+            raise AttributeError(name)
+        return getattr(self._recordset(), name)
+
+    def __len__(self):
+        return self._count
+
+    def __nonzero__(self):
+        return self._count > 0
+
+    def __iter__(self):
+        for index in xrange(self._count):
+            yield self._lines[index]
+
+    def __contains__(self, item):
+        return any(line == item for line in self)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if self._model is not None:
+                return self._recordset()[index]
+            return self._lines[:self._count][index]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        return self._lines[index]
+
+    def __add__(self, other):
+        return self._recordset() + other
+
+    def __or__(self, other):
+        return self._recordset() | other
+
+    def __and__(self, other):
+        return self._recordset() & other
+
+    def __sub__(self, other):
+        return self._recordset() - other
+
+    @property
+    def ids(self):
+        return [line.id for line in self]
+
+
+def _x2many_ids(value):
+    """ Return the ids of a value of a x2many field, given either as a
+    list of ids or as a list of commands """
+    ids = []
+    for item in value or []:
+        if not isinstance(item, (list, tuple)):
+            ids.append(item)
+        elif item[0] == 6:
+            ids = list(item[2])
+        elif item[0] == 4:
+            ids.append(item[1])
+        elif item[0] == 5:
+            ids = []
+        elif item[0] in (2, 3):
+            ids = [id_ for id_ in ids if id_ != item[1]]
+    return ids
+
+
+class _ValuesProxy(object):
+    """ Read-only access with attributes to a dict of values of a model,
+    like on a record
+
+    The many2one and x2many fields are returned as recordsets and the
+    missing fields as ``False``, so the methods preparing the arguments
+    of the onchanges can be used on the dict of values of a sale order
+    or a sale order line.
+    """
+
+    def __init__(self, model, values):
+        self._model = model
+        self._values = values
+
+    def __getattr__(self, name):
+        field = self._model._fields.get(name)
+        if field is None:
+            raise AttributeError(name)
+        value = self._values.get(name)
+        if field.type == 'many2one':
+            if isinstance(value, (list, tuple)):
+                value = value[0]
+            return self._model.env[field.comodel_name].browse(value or [])
+        if field.type in ('one2many', 'many2many'):
+            return self._model.env[field.comodel_name].browse(
+                _x2many_ids(value))
+        if value is None:
+            return False
+        return value
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    @property
+    def _fields(self):
+        return self._model._fields
+
+
+@job
+def play_values_chunk(session, model_name, backend_model, backend_id,
+                      orders, create_orders=False):
+    """ Play the onchanges on the values of a chunk of sale orders, see
+    ``SaleOrderOnChange.delay_play_values``
+
+    :param model_name: model of the ``SaleOrderOnChange`` unit
+    :param orders: list of tuples ``(order key, order values)``
+    :param create_orders: give the values to ``process_values``
+    :return: dict with the values of the sale orders by order key in
+             ``results`` and the errors by order key in ``errors``
+    """
+    backend_record = session.env[backend_model].browse(backend_id)
+    connector_env = Environment(backend_record, session, model_name)
+    onchange = connector_env.get_connector_unit(SaleOrderOnChange)
+    results, errors = onchange.play_values_many(orders,
+                                                create_orders=create_orders)
+    return {'results': results, 'errors': errors}
 
 
 class OnChangeManager(ConnectorUnit):
@@ -30,6 +252,298 @@ class OnChangeManager(ConnectorUnit):
 class SaleOrderOnChange(OnChangeManager):
     _model_name = None
 
+    # all the fields which can be filled by the onchanges (including the
+    # onchanges of the dependencies: delivery, sale_stock, sale_margin,
+    # ...), by field triggering the onchange. With
+    # ``skip_filled_onchanges``, an onchange is not played when all its
+    # fields are already set. The results of the payment method and
+    # workflow process onchanges are cached with only these fields.
+    # The connectors must extend the lists when the onchanges of their
+    # modules fill other fields. The fields missing in the models are
+    # ignored.
+    _onchange_fields = {
+        'partner_id': ['partner_invoice_id',
+                       'partner_shipping_id',
+                       'pricelist_id',
+                       'fiscal_position',
+                       'payment_term',
+                       'user_id',
+                       'note',
+                       'section_id',
+                       'carrier_id',
+                       ],
+        'product_id': ['name',
+                       'price_unit',
+                       'tax_id',
+                       'product_uom',
+                       'product_uos',
+                       'product_uos_qty',
+                       'product_packaging',
+                       'th_weight',
+                       'delay',
+                       'purchase_price',
+                       ],
+        'payment_method_id': ['payment_term',
+                              'workflow_process_id',
+                              ],
+        'workflow_process_id': ['picking_policy',
+                                'order_policy',
+                                'invoice_quantity',
+                                'section_id',
+                                ],
+    }
+
+    def __init__(self, connector_env):
+        super(SaleOrderOnChange, self).__init__(connector_env)
+        # results of the onchanges by onchange and arguments, only
+        # during ``play_many`` with ``cache_onchanges``
+        self._onchange_caches = None
+        # keys of the cached results by onchange and record, used to
+        # invalidate them
+        self._onchange_cache_keys = None
+        # number of onchanges played and skipped, by onchange
+        self.executed_onchanges = Counter()
+        self.skipped_onchanges = Counter()
+        # when True, the onchanges are not played when all the fields
+        # they can fill (see ``_onchange_fields``) are already set
+        self.skip_filled_onchanges = False
+        # statistics of the onchanges, only between ``start_profiling``
+        # and ``stop_profiling``
+        self._profile = None
+
+    def start_profiling(self, threshold=ONCHANGE_SLOW_THRESHOLD):
+        """ Start recording the duration and number of queries of each
+        step of the onchanges: the whole sale order, the partner,
+        payment method and workflow process onchanges, and the product
+        onchange of each line.
+
+        The steps taking more than ``threshold`` seconds are logged and
+        listed in the report.
+
+        :param threshold: duration in seconds of a slow step
+        :type: float
+        """
+        self._profile = {'threshold': threshold,
+                         'steps': {},
+                         'slow': [],
+                         }
+
+    def stop_profiling(self):
+        """ Stop recording the statistics of the onchanges
+
+        :return: the report, see ``get_profile_report``
+        :rtype: dict
+        """
+        report = self.get_profile_report()
+        self._profile = None
+        return report
+
+    def get_profile_report(self):
+        """ Return the statistics recorded since ``start_profiling``
+
+        The report is a dict with:
+
+        * ``steps``: by step, a dict with the number of times the step
+          was played (``count``), its total and maximum duration in
+          seconds (``time``, ``max_time``) and its number of queries
+          (``queries``)
+        * ``slow``: a list of dicts with the ``step``, the ``record``
+          (name of the order, or id of the partner, payment method,
+          workflow process or product), the ``time`` and the
+          ``queries`` of the steps slower than the threshold
+
+        :rtype: dict
+        """
+        if self._profile is None:
+            return {'steps': {}, 'slow': []}
+        return copy.deepcopy({'steps': self._profile['steps'],
+                              'slow': self._profile['slow'],
+                              })
+
+    @contextmanager
+    def _profile_step(self, step, record):
+        """ Record the duration and number of queries of the code
+        executed in the context, when the onchanges are profiled
+
+        :param step: name of the step
+        :type: str
+        :param record: name or id identifying the step in the report
+        """
+        if self._profile is None:
+            yield
+            return
+        cr = self.env.cr
+        start = time.time()
+        start_queries = cr.sql_log_count
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            queries = cr.sql_log_count - start_queries
+            stats = self._profile['steps'].setdefault(
+                step, {'count': 0, 'time': 0., 'max_time': 0., 'queries': 0}
+            )
+            stats['count'] += 1
+            stats['time'] += duration
+            stats['max_time'] = max(stats['max_time'], duration)
+            stats['queries'] += queries
+            if duration > self._profile['threshold']:
+                _logger.warning('Onchange step %s for %s took %.3fs '
+                                'and %d queries',
+                                step, record, duration, queries)
+                self._profile['slow'].append({'step': step,
+                                              'record': record,
+                                              'time': duration,
+                                              'queries': queries,
+                                              })
+
+    def _skip_onchange(self, name, record):
+        """ Return True when the onchange ``name`` does not need to be
+        played because ``skip_filled_onchanges`` is active and all the
+        fields it can fill are already set on ``record``, and count the
+        onchange as skipped or executed.
+
+        :param name: name of the field triggering the onchange
+        :type: str
+        :param record: the sale order or sale order line, or their values
+        :type: recordset
+        """
+        skip = False
+        fields = self._onchange_fields.get(name)
+        if self.skip_filled_onchanges and fields:
+            skip = all(getattr(record, field_name)
+                       for field_name in fields
+                       if field_name in record._fields)
+        if skip:
+            self.skipped_onchanges[name] += 1
+        else:
+            self.executed_onchanges[name] += 1
+        return skip
+
+    def _start_onchange_caches(self):
+        """ Start caching the results of the onchanges """
+        self._onchange_caches = {}
+        self._onchange_cache_keys = {}
+        _caching_onchanges.add(self)
+
+    def _stop_onchange_caches(self):
+        """ Stop caching the results of the onchanges and drop them """
+        _caching_onchanges.discard(self)
+        self._onchange_caches = None
+        self._onchange_cache_keys = None
+
+    def _cached_onchange(self, name, key, onchange, record_id=None):
+        """ Return the result of the ``onchange`` function, from the
+        cache of the onchange ``name`` when the cache is active.
+
+        :param name: name of the onchange
+        :param key: arguments of the onchange, must be hashable
+        :param onchange: function without arguments calling the onchange
+        :param record_id: id of the record the result depends on, the
+                          result is dropped by
+                          ``invalidate_onchange_caches`` when the record
+                          is modified
+        """
+        if self._onchange_caches is None:
+            return onchange()
+        cache = self._onchange_caches.get(name)
+        if cache is None:
+            cache = self._onchange_caches[name] = LRU(ONCHANGE_CACHE_SIZE)
+        try:
+            result = cache[key]
+        except KeyError:
+            result = cache[key] = onchange()
+            if record_id is not None:
+                keys = self._onchange_cache_keys.setdefault(
+                    (name, record_id), set())
+                keys.add(key)
+        return copy.deepcopy(result)
+
+    def _invalidate_onchange_cache(self, name, record_ids):
+        """ Drop the results of the onchange ``name`` cached for the
+        records ``record_ids`` """
+        if self._onchange_caches is None:
+            return
+        cache = self._onchange_caches.get(name)
+        for record_id in record_ids:
+            keys = self._onchange_cache_keys.pop((name, record_id), ())
+            if cache is None:
+                continue
+            for key in keys:
+                if key in cache:
+                    del cache[key]
+
+    # fields loaded at once for all the sale orders by ``play_many``
+    _prefetch_fields = {
+        'res.partner': ['property_product_pricelist',
+                        'property_account_position',
+                        'property_payment_term',
+                        'user_id',
+                        'child_ids',
+                        ],
+        'product.pricelist': ['currency_id'],
+        'account.fiscal.position': ['tax_ids'],
+        'payment.method': ['payment_term_id'],
+        'sale.workflow.process': ['picking_policy',
+                                  'order_policy',
+                                  'invoice_quantity',
+                                  ],
+        'product.product': ['uom_id',
+                            'uos_id',
+                            'uos_coeff',
+                            'taxes_id',
+                            'weight',
+                            ],
+    }
+
+    def _prefetch_records(self, model_name, records):
+        """ Read the ``_prefetch_fields`` of all the records at once
+
+        :return: the records read
+        :rtype: recordset
+        """
+        model = self.env[model_name]
+        ids = set(record.id for record in records
+                  if record and isinstance(record.id, (int, long)))
+        records = model.browse(list(ids))
+        fields = [name for name in self._prefetch_fields.get(model_name, [])
+                  if name in model._fields]
+        if records and fields:
+            records.read(fields)
+        return records
+
+    def _prefetch(self, orders):
+        """ Load in the cache the records used by the onchanges of the
+        sale orders, with one read per model.
+
+        :param orders: list of tuples ``(order, order_lines)``
+        :type: list
+        """
+        products = []
+        for order, order_lines in orders:
+            products += [line.product_id for line in order.order_line]
+            if order_lines:
+                products += [line.product_id for line in order_lines]
+        partners = self._prefetch_records(
+            'res.partner', [order.partner_id for order, __ in orders])
+        self._prefetch_records(
+            'payment.method',
+            [order.payment_method_id for order, __ in orders])
+        self._prefetch_records(
+            'sale.workflow.process',
+            [order.workflow_process_id for order, __ in orders])
+        self._prefetch_records('product.product', products)
+        # the pricelists and fiscal positions can come from the
+        # partners through the onchange
+        self._prefetch_records(
+            'product.pricelist',
+            [order.pricelist_id for order, __ in orders] +
+            [partner.property_product_pricelist for partner in partners])
+        self._prefetch_records(
+            'account.fiscal.position',
+            [order.fiscal_position for order, __ in orders] +
+            [partner.property_account_position for partner in partners])
+
     def _get_partner_id_onchange_param(self, order):
         """ Prepare the arguments for calling the partner_id change
         on sale order. You can overwrite this method in your own
@@ -57,19 +571,90 @@ class SaleOrderOnChange(OnChangeManager):
         :rtype: dict
         """
         # Play partner_id onchange
-        args, kwargs = self._get_partner_id_onchange_param(order)
-        values = order.onchange_partner_id(*args, **kwargs)
-        for key, value in values.get('value', {}).iteritems():
-            if not getattr(order, key):
-                setattr(order, key, value)
+        if not self._skip_onchange('partner_id', order):
+            args, kwargs = self._get_partner_id_onchange_param(order)
+            with self._profile_step('partner_id', order.partner_id.id):
+                values = self._cached_onchange(
+                    'partner_id',
+                    _freeze((args, kwargs)),
+                    lambda: order.onchange_partner_id(*args, **kwargs),
+                    record_id=order.partner_id.id)
+            for key, value in values.get('value', {}).iteritems():
+                if not getattr(order, key):
+                    setattr(order, key, value)
 
         if order.payment_method_id:
-            order.onchange_payment_method_id_set_payment_term()
+            self._play_field_onchange(
+                order, 'payment_method_id',
+                'onchange_payment_method_id_set_payment_term')
 
         if order.workflow_process_id:
-            order.onchange_workflow_process_id()
+            self._play_field_onchange(order, 'workflow_process_id',
+                                      'onchange_workflow_process_id')
         return order
 
+    def _play_field_onchange(self, order, field_name, method_name):
+        """ Play an onchange of the sale order which depends only on
+        the field ``field_name``
+
+        When the onchanges are cached, the onchange is played on a new
+        sale order having only ``field_name``, and the values it sets
+        on the fields declared in ``_onchange_fields`` are kept in the
+        cache for the record of ``field_name``.
+
+        :param order: the sale order
+        :type: recordset
+        :param field_name: name of the field triggering the onchange
+        :type: str
+        :param method_name: name of the onchange method
+        :type: str
+        """
+        # these onchanges replace the values of the order, they are
+        # never skipped
+        self.executed_onchanges[field_name] += 1
+        with self._profile_step(field_name, order[field_name].id):
+            if self._onchange_caches is None:
+                getattr(order, method_name)()
+                return
+            values = self._get_field_onchange_values(field_name,
+                                                     method_name,
+                                                     order[field_name])
+            for key, value in values.iteritems():
+                setattr(order, key, value)
+
+    def _get_field_onchange_values(self, field_name, method_name, record):
+        """ Return the values set by an onchange of the sale order which
+        depends only on the field ``field_name``
+
+        The onchange is played on a new sale order having only
+        ``record`` in ``field_name``, and only the fields declared in
+        ``_onchange_fields`` are returned, cached for ``record`` when the
+        cache is active.
+
+        :param field_name: name of the field triggering the onchange
+        :type: str
+        :param method_name: name of the onchange method
+        :type: str
+        :param record: value of ``field_name``
+        :type: recordset
+
+        :return: the values set by the onchange, in the format of
+                 ``write()``
+        :rtype: dict
+        """
+        def onchange():
+            new_order = self.env['sale.order'].new({field_name: record.id})
+            getattr(new_order, method_name)()
+            values = {}
+            for name in self._onchange_fields[field_name]:
+                if new_order[name]:
+                    field = new_order._fields[name]
+                    values[name] = field.convert_to_write(new_order[name])
+            return values
+
+        return self._cached_onchange(field_name, record.id, onchange,
+                                     record_id=record.id)
+
     def _get_product_id_onchange_param(self, line, previous_lines, order):
         """ Prepare the arguments for calling the product_id change
         on sale order line. You can overwrite this method in your own
@@ -77,8 +662,8 @@ class SaleOrderOnChange(OnChangeManager):
 
         :param line: the sale order line to process
         :type: dict
-        :param previous_lines: list of dict of the previous lines processed
-        :type: list
+        :param previous_lines: the previous lines processed (read-only)
+        :type: recordset, or sequence of dict with ``play_values``
         :param order: data of the sale order
         :type: dict
 
@@ -123,8 +708,8 @@ class SaleOrderOnChange(OnChangeManager):
 
         :param line: the sale order line to process
         :type: dict
-        :param previous_lines: list of dict of the previous line processed
-        :type: list
+        :param previous_lines: the previous lines processed (read-only)
+        :type: recordset
         :param order: data of the sale order
         :type: dict
 
@@ -132,11 +717,18 @@ class SaleOrderOnChange(OnChangeManager):
         :rtype: dict
         """
         # Play product_id onchange
+        if self._skip_onchange('product_id', line):
+            return line
         args, kwargs = self._get_product_id_onchange_param(line,
                                                            previous_lines,
                                                            order)
         context = kwargs.pop('context', {})
-        values = line.with_context(context).product_id_change(*args, **kwargs)
+        with self._profile_step('product_id', line.product_id.id):
+            values = self._cached_onchange(
+                'product_id',
+                _freeze((args, kwargs, context)),
+                lambda: line.with_context(context).product_id_change(
+                    *args, **kwargs))
         for key, value in values.get('value', {}).iteritems():
             if not getattr(line, key):
                 setattr(line, key, value)
@@ -158,22 +750,426 @@ class SaleOrderOnChange(OnChangeManager):
         :return: the sale order updated by the onchanges
         :rtype: recordset
         """
-        # play onchange on sale order
-        order = self._play_order_onchange(order)
-        processed_order_lines = self.env['sale.order.line'].browse()
-        # we can have both backend-dependent and oerp-native order
-        # lines.
-        # oerp-native lines can have been added to map
-        # shipping fees with an OpenERP Product
-        all_lines = order.order_line
-        if order_lines:
-            all_lines |= order_lines
-        for line in all_lines:
-            # play onchange on sale order line
-            new_line = self._play_line_onchange(line,
-                                                processed_order_lines,
-                                                order)
-            processed_order_lines += new_line
-            # in place modification of the sale order line in the list
-        order.order_line = processed_order_lines
+        with self._profile_step('order', order.name):
+            # play onchange on sale order
+            order = self._play_order_onchange(order)
+            # the lines are accumulated in a list and the previous lines
+            # are given as a view on it, so each line does not copy the
+            # lines already processed
+            processed_order_lines = []
+            # we can have both backend-dependent and oerp-native order
+            # lines.
+            # oerp-native lines can have been added to map
+            # shipping fees with an OpenERP Product
+            all_lines = order.order_line
+            if order_lines:
+                all_lines |= order_lines
+            for line in all_lines:
+                # play onchange on sale order line
+                previous_lines = _PreviousLines(processed_order_lines,
+                                                len(processed_order_lines),
+                                                model=all_lines.browse())
+                new_line = self._play_line_onchange(line,
+                                                    previous_lines,
+                                                    order)
+                processed_order_lines.append(new_line)
+                # in place modification of the sale order line in the list
+            order.order_line = self.env['sale.order.line'].browse(
+                [line.id for line in processed_order_lines])
         return order
+
+    def _update_values(self, model, values, onchange_values,
+                       given_values=None):
+        """ Apply the values returned by an onchange on the fields
+        missing in ``values``
+
+        :param model: model of the values
+        :type: recordset
+        :param values: values of the record, updated in place
+        :type: dict
+        :param onchange_values: values returned by the onchange
+        :type: dict
+        :param given_values: when given, the onchange values are applied
+                             on the fields missing in ``given_values``,
+                             replacing the values set by the previous
+                             onchanges
+        :type: dict
+        """
+        if given_values is None:
+            given_values = values
+        for key, value in onchange_values.iteritems():
+            if given_values.get(key):
+                continue
+            field = model._fields.get(key)
+            if field is None:
+                continue
+            if isinstance(value, models.BaseModel):
+                value = field.convert_to_write(value)
+            elif field.type == 'many2one' and isinstance(value,
+                                                         (list, tuple)):
+                value = value[0]
+            elif (field.type in ('one2many', 'many2many') and
+                    value and not isinstance(value[0], (list, tuple))):
+                value = [(6, 0, list(value))]
+            values[key] = value
+
+    def _play_order_values_onchange(self, order_vals):
+        """ Play the onchange of the sale order on its values
+
+        The values returned by the onchanges are applied only on the
+        missing fields.
+
+        :param order_vals: values of the sale order, updated in place
+        :type: dict
+
+        :return: the values of the sale order
+        :rtype: dict
+        """
+        sale_model = self.env['sale.order']
+        order = _ValuesProxy(sale_model, order_vals)
+        given_values = dict(order_vals)
+        # Play partner_id onchange
+        if not self._skip_onchange('partner_id', order):
+            args, kwargs = self._get_partner_id_onchange_param(order)
+            with self._profile_step('partner_id', order.partner_id.id):
+                values = self._cached_onchange(
+                    'partner_id',
+                    _freeze((args, kwargs)),
+                    lambda: sale_model.onchange_partner_id(*args, **kwargs),
+                    record_id=order.partner_id.id)
+            self._update_values(sale_model, order_vals,
+                                values.get('value', {}))
+
+        # as in ``play``, the payment method and workflow process
+        # onchanges replace the values set by the partner onchange
+        given = _ValuesProxy(sale_model, given_values)
+        for field_name, method_name in (
+                ('payment_method_id',
+                 'onchange_payment_method_id_set_payment_term'),
+                ('workflow_process_id', 'onchange_workflow_process_id')):
+            record = order[field_name]
+            if record and not self._skip_onchange(field_name, given):
+                with self._profile_step(field_name, record.id):
+                    values = self._get_field_onchange_values(field_name,
+                                                             method_name,
+                                                             record)
+                self._update_values(sale_model, order_vals, values,
+                                    given_values=given_values)
+        return order_vals
+
+    def _play_line_values_onchange(self, line_vals, previous_lines,
+                                   order_vals):
+        """ Play the onchange of the sale order line on its values
+
+        The values returned by the onchanges are applied only on the
+        missing fields.
+
+        :param line_vals: values of the sale order line, updated in place
+        :type: dict
+        :param previous_lines: the values of the previous lines
+                               processed (read-only)
+        :type: sequence of dict
+        :param order_vals: values of the sale order
+        :type: dict
+
+        :return: the values of the sale order line
+        :rtype: dict
+        """
+        line_model = self.env['sale.order.line']
+        line = _ValuesProxy(line_model, line_vals)
+        order = _ValuesProxy(self.env['sale.order'], order_vals)
+        # Play product_id onchange
+        if self._skip_onchange('product_id', line):
+            return line_vals
+        args, kwargs = self._get_product_id_onchange_param(line,
+                                                           previous_lines,
+                                                           order)
+        context = kwargs.pop('context', {})
+        with self._profile_step('product_id', line.product_id.id):
+            values = self._cached_onchange(
+                'product_id',
+                _freeze((args, kwargs, context)),
+                lambda: line_model.with_context(context).product_id_change(
+                    *args, **kwargs))
+        self._update_values(line_model, line_vals, values.get('value', {}))
+        return line_vals
+
+    def play_values(self, order_vals, lines_vals=None):
+        """ Play the onchange of the sale order and its lines on their
+        values, without building records
+
+        The values returned by the onchanges are applied only on the
+        fields missing in the values, the result can be given to
+        ``create()``.
+
+        :param order_vals: values of the sale order, the lines can be
+                           given in ``order_line`` with ``(0, 0, vals)``
+                           commands
+        :type: dict
+        :param lines_vals: values of extra sale order lines
+        :type: list of dict
+
+        :return: the values of the sale order updated by the onchanges,
+                 with all the lines in ``order_line``
+        :rtype: dict
+        """
+        order_vals, all_lines, other_commands = self._split_order_lines(
+            order_vals)
+        all_lines += [dict(vals) for vals in lines_vals or []]
+
+        with self._profile_step('order', order_vals.get('name')):
+            order_vals = self._play_order_values_onchange(order_vals)
+            processed_order_lines = []
+            for line_vals in all_lines:
+                previous_lines = _PreviousLines(processed_order_lines,
+                                                len(processed_order_lines))
+                line_vals = self._play_line_values_onchange(line_vals,
+                                                            previous_lines,
+                                                            order_vals)
+                processed_order_lines.append(line_vals)
+            order_vals['order_line'] = other_commands + [
+                (0, 0, processed_vals)
+                for processed_vals in processed_order_lines]
+        return order_vals
+
+    def _split_order_lines(self, order_vals):
+        """ Extract the lines to create from the values of a sale order
+
+        :return: a tuple with a copy of the values of the sale order
+                 without ``order_line``, the values of the lines to
+                 create and the other commands of ``order_line``
+        :rtype: tuple
+        """
+        order_vals = dict(order_vals)
+        lines = []
+        other_commands = []
+        for command in order_vals.pop('order_line', None) or []:
+            if command[0] == 0:
+                lines.append(dict(command[2]))
+            else:
+                other_commands.append(command)
+        return order_vals, lines, other_commands
+
+    def play_values_iter(self, order_vals, lines_vals=None,
+                         chunk_size=ONCHANGE_LINES_CHUNK_SIZE):
+        """ Play the onchanges on the values of a sale order and return
+        the values of its lines as a generator, for the sale orders with
+        too many lines to be kept in memory at once
+
+        The lines are processed when the generator is consumed. After
+        each chunk of ``chunk_size`` lines, the cache of the models read
+        by the onchanges of the lines (``_lines_cached_models``) is
+        invalidated, so their records do not stay in memory. The
+        ``new()`` records of these models would lose their values, the
+        cache of the other models is kept. ``previous_lines`` only
+        contains the lines of the current chunk.
+
+        :param order_vals: values of the sale order, lines can be given
+                           in ``order_line`` with ``(0, 0, vals)``
+                           commands
+        :type: dict
+        :param lines_vals: values of the sale order lines, can be
+                           a generator
+        :type: iterable of dict
+        :param chunk_size: number of lines processed between two
+                           invalidations of the cache
+        :type: int
+
+        :return: a tuple with the values of the sale order updated by
+                 the onchanges, without the lines to create, and a
+                 generator of the values of the lines updated by the
+                 onchanges
+        :rtype: tuple
+        """
+        order_vals, lines, other_commands = self._split_order_lines(
+            order_vals)
+        if other_commands:
+            order_vals['order_line'] = other_commands
+        order_vals = self._play_order_values_onchange(order_vals)
+        all_lines = itertools.chain(lines, lines_vals or [])
+        return order_vals, self._iter_lines_values(order_vals, all_lines,
+                                                   chunk_size)
+
+    # models loaded in the cache by the onchanges of the lines, their
+    # cache is invalidated between the chunks of ``play_values_iter``
+    _lines_cached_models = ['product.product',
+                            'product.template',
+                            'product.uom',
+                            'product.pricelist',
+                            'product.pricelist.version',
+                            'product.pricelist.item',
+                            'account.tax',
+                            'account.fiscal.position',
+                            'account.fiscal.position.tax',
+                            ]
+
+    def _invalidate_lines_cache(self):
+        """ Invalidate the cache of the ``_lines_cached_models`` """
+        spec = []
+        for model_name in self._lines_cached_models:
+            if model_name in self.env.registry:
+                model = self.env[model_name]
+                spec += [(field, None) for field in model._fields.values()]
+        self.env.invalidate(spec)
+
+    def _iter_lines_values(self, order_vals, lines_vals, chunk_size):
+        """ Generator playing the onchanges on the values of the lines
+        by chunks, see ``play_values_iter`` """
+        processed_order_lines = []
+        for line_vals in lines_vals:
+            if len(processed_order_lines) >= chunk_size:
+                processed_order_lines = []
+                self._invalidate_lines_cache()
+            previous_lines = _PreviousLines(processed_order_lines,
+                                            len(processed_order_lines))
+            line_vals = self._play_line_values_onchange(dict(line_vals),
+                                                        previous_lines,
+                                                        order_vals)
+            processed_order_lines.append(line_vals)
+            yield line_vals
+
+    def process_values(self, order_key, values):
+        """ Process the values of a sale order updated by the onchanges
+        in ``play_values_many`` when ``create_orders`` is set
+
+        Create the sale order by default, the connectors inherit it to
+        create their bindings.
+
+        :param order_key: key of the sale order given to
+                          ``play_values_many``
+        :param values: values returned by ``play_values``
+        :type: dict
+        """
+        self.env['sale.order'].create(values)
+
+    def play_values_many(self, orders, create_orders=False):
+        """ Play the onchanges on the values of many sale orders
+
+        The results of the onchanges are cached during the batch, see
+        ``play_many``. Each sale order is processed in a savepoint, the
+        failed sale orders are logged and their errors returned, the
+        other ones are still processed. ``RetryableJobError`` and the
+        concurrency errors of PostgreSQL are raised, so a job can be
+        retried.
+
+        :param orders: list of tuples ``(order key, order values)``,
+                       the lines are given in ``order_line`` with
+                       ``(0, 0, vals)`` commands
+        :type: list
+        :param create_orders: give the values of each sale order to
+                              ``process_values``, which creates it
+        :type: bool
+
+        :return: a tuple with the values returned by ``play_values`` by
+                 order key and the error messages by order key
+        :rtype: tuple
+        """
+        cr = self.connector_env.session.cr
+        results = {}
+        errors = {}
+        self._start_onchange_caches()
+        try:
+            for order_key, order_vals in orders:
+                try:
+                    with cr.savepoint():
+                        values = self.play_values(order_vals)
+                        if create_orders:
+                            self.process_values(order_key, values)
+                except RetryableJobError:
+                    raise
+                except Exception as err:
+                    if (isinstance(err, psycopg2.OperationalError) and
+                            err.pgcode in PG_CONCURRENCY_ERRORS_TO_RETRY):
+                        raise
+                    _logger.exception('Onchanges of the sales order %s '
+                                      'failed', order_key)
+                    errors[order_key] = ustr(err)
+                else:
+                    results[order_key] = values
+        finally:
+            self._stop_onchange_caches()
+        return results, errors
+
+    def delay_play_values(self, orders, chunk_size=ONCHANGE_JOB_CHUNK_SIZE,
+                          create_orders=False, **kwargs):
+        """ Play the onchanges on the values of many sale orders in jobs
+
+        The sale orders are split in jobs of ``chunk_size`` sale orders,
+        so a backlog of sale orders is processed by all the job workers.
+        Each job looks up the ``SaleOrderOnChange`` unit of the backend
+        and calls ``play_values_many``. The result of a job is a dict
+        with the values of its sale orders by order key in ``results``
+        and the error messages of the failed ones in ``errors``.
+
+        :param orders: values of the sale orders by order key, the lines
+                       are given in ``order_line`` with ``(0, 0, vals)``
+                       commands
+        :type: dict
+        :param chunk_size: number of sale orders processed by a job
+        :type: int
+        :param create_orders: give the values of each sale order to
+                              ``process_values``, which creates it
+        :type: bool
+        :param kwargs: options of the jobs (``priority``, ``eta``, ...)
+
+        :return: the uuids of the jobs by order key
+        :rtype: dict
+        """
+        session = self.connector_env.session
+        backend_record = self.connector_env.backend_record
+        orders = orders.items()
+        job_uuids = {}
+        for index in xrange(0, len(orders), chunk_size):
+            chunk = orders[index:index + chunk_size]
+            job_uuid = play_values_chunk.delay(
+                session, self.connector_env.model_name,
+                backend_record._name, backend_record.id,
+                chunk, create_orders=create_orders, **kwargs)
+            for order_key, __ in chunk:
+                job_uuids[order_key] = job_uuid
+        return job_uuids
+
+    def play_many(self, orders, cache_onchanges=False):
+        """ Play the onchanges of many sale orders and their lines
+
+        The records used by the onchanges (partners, pricelists,
+        fiscal positions, payment methods, products, ...) are read at
+        once for all the sale orders before the onchanges are played.
+        The result is the same than calling ``play`` on each sale order.
+
+        With ``cache_onchanges``, the results of the onchanges are kept
+        during the batch (up to ``ONCHANGE_CACHE_SIZE`` results per
+        onchange):
+
+        * ``product_id_change`` is called once for the lines with the
+          same arguments (product, quantity, pricelist, partner, ...)
+        * ``onchange_partner_id`` once per partner
+        * the payment method and workflow process onchanges once per
+          payment method and workflow process
+
+        The results cached for a partner, payment method or workflow
+        process are dropped when it is modified (for a partner, also
+        when one of its contacts is modified), see
+        ``invalidate_onchange_caches``.
+
+        :param orders: list of sale orders or of tuples
+                       ``(order, order_lines)`` with the arguments of
+                       ``play``
+        :type: list
+        :param cache_onchanges: cache the results of the onchanges
+                                during the batch
+        :type: bool
+
+        :return: the sale orders updated by the onchanges
+        :rtype: list
+        """
+        orders = [order if isinstance(order, tuple) else (order, None)
+                  for order in orders]
+        self._prefetch(orders)
+        if cache_onchanges:
+            self._start_onchange_caches()
+        try:
+            return [self.play(order, order_lines=order_lines)
+                    for order, order_lines in orders]
+        finally:
+            self._stop_onchange_caches()